@@ -3,18 +3,53 @@ import json
 import requests
 import os
 import logging
+import time
 import pkgutil
-from modules import applications, groups, users, wrapping, publishing
+import threading
+from modules import concurrency, jsonrpc, regions
+from modules.transport import Transport
+from modules.tokens import TokenCache, AuthSession
+from modules.concurrency import imap_unordered
+from modules.watcher import JobWatcher
+from modules.cache import ResponseCache
 from modules.helpers import display_options, response_check
 __author__ = 'Shawn Roche'
 
-ENDPOINTS = json.loads(pkgutil.get_data('apperian', 'endpoints.json'))
-# with open('endpoints.json', 'rb') as f:
-#     ENDPOINTS = json.load(f)
+# Region name to its URLs. Read from endpoints.json by load_endpoints() the first time a region is looked up by name
+ENDPOINTS = None
+
+# Connector attributes of Ease. Each one is built the first time it is used, see Ease.build_connector()
+CONNECTORS = ['publish', 'app', 'group', 'user', 'wrapper']
+
+
+def load_endpoints():
+    """
+    :return: ENDPOINTS, after reading endpoints.json if it has not been read yet
+    """
+    global ENDPOINTS
+    if ENDPOINTS is None:
+        ENDPOINTS = json.loads(pkgutil.get_data('apperian', 'endpoints.json'))
+    return ENDPOINTS
+
+# Seconds after authenticating during which a rejected request is not retried with a new token. The PHP Web Services
+# answer every failed call with an error, so this keeps calls that fail for other reasons from re-authenticating
+MIN_TOKEN_AGE = 60
 
 
 class Ease:
-    def __init__(self, user, pw, region='default', verbose=False, php=None, py=None):
+    def __init__(self, user, pw, region='default', verbose=False, php=None, py=None, cache=False, transport=None,
+                 token_cache=None, lazy=False):
+        """
+        :param region: Optional. Region name from endpoints.json, 'list' to choose one, 'auto' to pick the fastest
+            one the credentials work in, or a dict of the region's URLs with the same keys as endpoints.json
+        :param cache: Optional. True to cache responses from the read-only endpoints with the default ttls, or a
+            ResponseCache instance to control ttls and size. Hit/miss counters are available from self.cache.stats()
+        :param transport: Optional. Transport with the pool sizes, timeouts, retries and keep-alive to use for every
+            session. Defaults to Transport()
+        :param token_cache: Optional. True to reuse tokens saved in ~/.apperian/tokens.json, or a TokenCache
+            instance, so a new instance does not authenticate again while the last token is still valid
+        :param lazy: Optional. If True, authenticate on the first request instead of here. valid is True until then
+        """
         self.verbose = verbose
         log_level = logging.DEBUG if self.verbose else logging.CRITICAL
         logging.basicConfig(format="[%(levelname)8s] %(message)s", level=log_level)
@@ -22,16 +57,29 @@ class Ease:
         self.password = pw
         self.user_data = {}
         self.region, self.token = region, ''
-        self.user, self.app, self.group, self.wrapper, self.publish = '', '', '', '', ''
+        self.lazy = lazy
+        self.token_cache = TokenCache() if token_cache is True else token_cache or None
+        self.token_time = 0
+        self.auth_lock = threading.Lock()
+        # The connectors (app, group, user, wrapper, publish) are built on first use. See __getattr__
+        self.raw_connectors = {}
+        self.connector_lock = threading.RLock()
+        # All sessions share the transport's connection pools
+        self.transport = transport or Transport()
         # Setup python session
         self.py = py
-        self.py_session = requests.Session()
+        # Authenticates before the first request and again when a request gets a 401
+        self.py_session = AuthSession(self.refresh_token)
         self.py_session.headers.update({"Content-Type": "application/json"})
+        self.transport.mount(self.py_session)
         # Setup php session
         self.php = php
         self.php_session = requests.Session()
         self.php_session.headers = {"Content-Type": "application/js"}
-        self.php_payload = {"id": 1, "apiVersion": "1.0", "method": "", "jsonrpc": "2.0"}
+        self.transport.mount(self.php_session)
+        self.upload_session = self.transport.session()
+        self.rpc = None
+        self.cache = ResponseCache() if cache is True else cache or None
 
         self.valid = Ease.set_region(self, region)
 
@@ -49,51 +97,152 @@ class Ease:
         if password:
             self.password = password
 
+        with self.auth_lock:
+            resp = Ease.request_token(self)
+        if resp['status'] == 200:
+            self.connectors()
+            return resp['result']['token']
+        else:
+            return False
+
+    def request_token(self):
+        """
+        Sends the credentials to /users/authenticate/ and, if they are accepted, starts using the new token and saves
+        it to the token cache
+        """
         # Python auth
         payload = json.dumps({'user_id': self.username, 'password': self.password})
         url = '%s/users/authenticate/' % self.region['Python Web Services']
         if self.verbose:
             logging.debug('Sending auth via {}'.format(url))
-        r = self.py_session.post(url, data=payload)
+        r = self.py_session.post(url, data=payload, retry_auth=False)
 
         resp = response_check(r)
 
         if resp['status'] == 200:
-            self.token = resp['result']['token']
-            self.user_data = resp['result']
-            self.py_session.headers.update({'X-TOKEN': self.token})
-            self.php_payload["params"] = {"token": self.token}
-            Ease.connectors(self)
-            return resp['result']['token']
+            Ease.use_token(self, resp['result'])
+            if self.token_cache:
+                self.token_cache.set(self.username, self.region, resp['result'])
         else:
             if self.verbose:
                 logging.debug('Auth failed\n{}'.format(r.text))
-            return False
+            if self.token_cache:
+                self.token_cache.remove(self.username, self.region)
+        return resp
+
+    def use_token(self, user_data, issued=None):
+        """
+        Points the sessions, the RPC client and the wrapper at a token, without rebuilding the connectors
+
+        :param user_data: Result of /users/authenticate/, or {} to clear the token
+        :param issued: Optional. Time the token was issued. Defaults to now
+        """
+        self.token = user_data.get('token', '')
+        self.user_data = user_data
+        self.token_time = time.time() if issued is None else issued
+        if self.token:
+            self.py_session.headers.update({'X-TOKEN': self.token})
+        else:
+            self.py_session.headers.pop('X-TOKEN', None)
+        if self.rpc is None:
+            self.rpc = jsonrpc.RPC(self.php_session, self.region['PHP Web Services'], self.token, self.refresh_token)
+        else:
+            self.rpc.url, self.rpc.token = self.region['PHP Web Services'], self.token
+        if 'wrapper' in self.raw_connectors:
+            self.raw_connectors['wrapper'].user_psk = user_data.get('user', {}).get('psk')
+
+    def refresh_token(self, stale=None):
+        """
+        Called by the sessions and the RPC client before each request, and again with the token a request was sent
+        with when it is rejected. Authenticates if there is no token yet or the rejected token is still in use.
+
+        :param stale: Optional. Token the server rejected
+        :return: True if there is a token to retry with
+        """
+        with self.auth_lock:
+            if self.token and self.token != stale:
+                return True
+            if stale is not None and time.time() - self.token_time < MIN_TOKEN_AGE:
+                return False
+            return Ease.request_token(self)['status'] == 200
+
+    def login(self):
+        """
+        Builds the connectors with a token from the token cache, without a token if lazy, or by authenticating
+
+        :return: The token, True if lazy and there is no token yet, or False if authentication failed
+        """
+        user_data = self.token_cache.get(self.username, self.region) if self.token_cache else None
+        if user_data:
+            # Issued at 0 so a 401 from the server gets a new token straight away
+            Ease.use_token(self, user_data, 0)
+        elif self.lazy:
+            Ease.use_token(self, {}, 0)
+        else:
+            return Ease.auth(self)
+        self.connectors()
+        return self.token or True
 
     def set_region(self, region):
         """
         Change the region you access for this session and authenticates you to the new environment.
         If 'list' is provided as the value for region you will see a list of options to manually choose from.
 
-        :param region: Optional. Provide alternate region string. Use region='list' to manually select one
+        :param region: Optional. Provide alternate region string. Use region='list' to manually select one, or
+            region='auto' to pick the fastest region the credentials work in without prompting. See select_region()
         """
 
-        if self.php and self.py:
+        if isinstance(region, dict):
+            self.region = region
+        elif self.php and self.py:
             self.region = {
                 'PHP Web Services': 'https://{}/ease.interface.php'.format(self.php),
                 'Python Web Services': 'https://{}'.format(self.py),
                 'File Uploader': 'https://{}'.format(self.php.replace('easesvc', 'fupload'))
             }
+        elif region.lower() == 'auto':
+            return Ease.select_region(self)
         else:
-            key = ENDPOINTS.get(region.lower())
+            key = load_endpoints().get(region.lower())
             if key:
                 self.region = key
             else:
                 if region != 'list':
                     print "%s is not a valid format. Please make a selection from below:" % region
-                self.region = display_options(ENDPOINTS, 'region')
+                self.region = display_options(load_endpoints(), 'region')
+
+        return Ease.login(self)
 
-        return Ease.auth(self)
+    def select_region(self, candidates=None, path=None):
+        """
+        Probes the Python Web Services host of every candidate region at the same time and authenticates to the
+        fastest ones in turn until the credentials are accepted. The region picked is saved for the user, and used
+        straight away next time, for a day.
+
+        :param candidates: Optional. Dict of region name to its URLs. The password is sent to each one until it is
+            accepted. Defaults to the regions in regions.PRODUCTION_REGIONS
+        :param path: Optional. json file to save the region picked to. Defaults to ~/.apperian/regions.json
+        :return: The token, or False if the credentials did not work in any region that could be reached
+        """
+        if not candidates:
+            endpoints = load_endpoints()
+            candidates = dict((i, endpoints[i]) for i in regions.PRODUCTION_REGIONS if i in endpoints)
+        name = regions.cached_region(self.username, path)
+        if name in candidates:
+            self.region = candidates[name]
+            token = Ease.login(self)
+            if token:
+                return token
+            logging.debug('Saved region %s rejected the credentials, probing every region', name)
+
+        for name, latency in regions.rank(candidates):
+            self.region = candidates[name]
+            token = Ease.auth(self)
+            if token:
+                regions.save_region(self.username, name, path)
+                return token
+        logging.debug('No region accepted the credentials')
+        return False
 
     def set_default_region(self):
         """
@@ -105,22 +254,111 @@ class Ease:
         You are about to change the default region this module uses for all future sessions.
         Make a selection from one of the below regions:
         """
-        ENDPOINTS['default'] = display_options(ENDPOINTS, 'region')
-        self.region = ENDPOINTS['default']
+        endpoints = load_endpoints()
+        endpoints['default'] = display_options(endpoints, 'region')
+        self.region = endpoints['default']
         Ease.auth(self, self.username, self.password)
 
         package_dir, package = os.path.split(__file__)
         data_path = os.path.join(package_dir, 'data', 'endpoints.json')
         with open(data_path, 'wb') as f:
-            f.write(json.dumps(ENDPOINTS, indent=4, separators=(',', ': ')))
+            f.write(json.dumps(endpoints, indent=4, separators=(',', ': ')))
 
     def connectors(self):
-        self.app = applications.Apps(self.py_session, self.php_session, self.php_payload, self.region)
-        self.group = groups.Groups(self.py_session, self.region)
-        self.user = users.Users(self.py_session, self.region)
-        self.wrapper = wrapping.Wrapper(self.php_session, self.php_payload, self.app, self.region,
-                                        self.user_data['user']['psk'])
-        self.publish = publishing.Publish(self.php_session, self.php_payload, self.py_session, self.region)
+        """
+        Drops the connectors so each one is built again, for the current region and token, the next time it is used
+        """
+        with self.connector_lock:
+            for name in CONNECTORS:
+                self.__dict__.pop(name, None)
+            self.raw_connectors = {}
+            # One watcher for the whole session so every sign and wrap job is polled together
+            self.watcher = JobWatcher()
+
+    def __getattr__(self, name):
+        """
+        Builds a connector the first time it is used, so scripts only pay for the ones they need
+        """
+        if name not in CONNECTORS or 'raw_connectors' not in self.__dict__:
+            raise AttributeError(name)
+        with self.connector_lock:
+            if name not in self.__dict__:
+                self.__dict__[name] = self.expose(Ease.connector(self, name))
+            return self.__dict__[name]
+
+    def connector(self, name):
+        """
+        :param name: One of CONNECTORS
+        :return: The connector instance, not wrapped by expose()
+        """
+        with self.connector_lock:
+            if name not in self.raw_connectors:
+                self.raw_connectors[name] = Ease.build_connector(self, name)
+            return self.raw_connectors[name]
+
+    def build_connector(self, name):
+        # The connector modules are imported on first use to keep import apperian fast
+        if name == 'publish':
+            from modules.publishing import Publish
+            return Publish(self.php_session, self.rpc, self.py_session, self.region, self.cache,
+                           upload_session=self.upload_session)
+        elif name == 'app':
+            from modules.applications import Apps
+            app = Apps(self.py_session, self.php_session, self.rpc, self.region, self.cache,
+                       Ease.connector(self, 'publish'))
+            app.watcher, self.watcher.apps = self.watcher, app
+            return app
+        elif name == 'group':
+            from modules.groups import Groups
+            return Groups(self.py_session, self.region, self.cache)
+        elif name == 'user':
+            from modules.users import Users
+            return Users(self.py_session, self.region, self.cache)
+        elif name == 'wrapper':
+            from modules.wrapping import Wrapper
+            wrapper = Wrapper(self.php_session, self.rpc, Ease.connector(self, 'app'), self.region,
+                              self.user_data.get('user', {}).get('psk'), self.cache)
+            wrapper.watcher, self.watcher.wrapper = self.watcher, wrapper
+            return wrapper
+
+    def expose(self, connector):
+        """
+        :return: What the connector attribute is set to. AsyncEase wraps it in an AsyncConnector
+        """
+        return connector
+
+    def rollout(self, app_psks, policies, cred_psk, workers=4, state_file=None, timeout=None):
+        """
+        Wraps and then signs every app in app_psks. See modules.rollout.Rollout
+
+        :param app_psks: List of psks of the apps to wrap and sign
+        :param policies: List of policy numbers to apply. See Wrapper.convert_policies()
+        :param cred_psk: Unique ID of the signing credentials
+        :param workers: Number of apps to have in flight at the same time
+        :param state_file: Optional. Path of a json file to save progress to so an interrupted run can be resumed
+        :param timeout: Optional. Seconds to wait for each wrap or sign job
+        :return: List of dicts with the keys: psk, stage, status, result. Rollout.format_table() prints it as a table
+        """
+        from modules.rollout import Rollout
+        rollout = Rollout(Ease.connector(self, 'app'), Ease.connector(self, 'wrapper'), policies, cred_psk, workers,
+                          state_file, timeout)
+        return rollout.run(app_psks)
+
+    def mirror(self, path=':memory:', workers=8):
+        """
+        Builds a local SQLite copy of the org's apps, users, groups and group memberships. See modules.mirror.OrgMirror
+
+        :param path: Optional. Database file to keep the mirror in, so later runs only fetch what changed
+        :param workers: Number of group memberships to fetch at once
+        :return: OrgMirror instance, already refreshed. Call its refresh() again to pick up changes
+        """
+        from modules.mirror import OrgMirror
+        org_mirror = OrgMirror(Ease.connector(self, 'app'), Ease.connector(self, 'user'), Ease.connector(self, 'group'),
+                               path, workers)
+        resp = org_mirror.refresh()
+        if resp['status'] != 200:
+            logging.debug('Mirror refresh failed: %s', resp['result'])
+        return org_mirror
 
     ######################################
     # Org Functions
@@ -135,3 +373,116 @@ class Ease:
         r = self.py_session.delete(url)
         result = response_check(r, 'deleted_organization')
         return result
+
+
+class AsyncEase(Ease):
+    def __init__(self, user, pw, region='default', verbose=False, php=None, py=None, cache=False, max_workers=16,
+                 transport=None, token_cache=None, lazy=False):
+        """
+        Same as Ease, but every connector method (app, group, user, wrapper, publish) returns an AsyncResult
+        instead of blocking. Call .get() on it, or pass a list of them to gather(), to get the usual
+        {'status', 'result'} dict. At most max_workers requests are in flight at once.
+
+        :param max_workers: Size of the thread pool shared by all connectors
+        :param transport: Optional. Defaults to a Transport with a pooled connection per worker for each host,
+            otherwise urllib3 discards the extras
+        """
+        self.max_workers = max_workers
+        self.pool = concurrency.new_pool(max_workers)
+        Ease.__init__(self, user, pw, region, verbose, php, py, cache, transport or Transport(pool_maxsize=max_workers),
+                      token_cache, lazy)
+
+    def expose(self, connector):
+        return concurrency.AsyncConnector(connector, self.pool)
+
+    @staticmethod
+    def gather(results, timeout=None):
+        """
+        :param results: List of AsyncResult objects returned by the connectors
+        :param timeout: Optional. Seconds to wait for each call
+        :return: List of {'status', 'result'} dicts in the same order as results
+        """
+        return concurrency.gather(results, timeout)
+
+    def close(self):
+        """
+        Waits for outstanding calls to finish and shuts down the thread pool
+        """
+        self.pool.close()
+        self.pool.join()
+
+
+class EaseManager:
+    def __init__(self, transport=None, workers=8):
+        """
+        Holds Ease clients for many orgs that all send their requests through one Transport, so every org reuses
+        the same pooled connections to each region host instead of opening its own. Each client keeps its own
+        sessions, with its own X-TOKEN header and cookies, on top of the shared pools.
+
+        :param transport: Optional. Transport shared by every client. Defaults to one with workers connections
+            per host
+        :param workers: Number of orgs to authenticate or run a function for at the same time
+        """
+        self.transport = transport or Transport(pool_maxsize=workers)
+        self.workers = workers
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def client(self, user, pw, region='default', **kwargs):
+        """
+        Returns the client for user and region, authenticating a new one if there isn't one yet
+
+        :param user: User ID of an EASE user of the org
+        :param pw: User's password
+        :param region: Optional. Region name from endpoints.json, or a dict of the region's URLs
+        :param kwargs: Optional. Any other Ease arguments, for example cache=True
+        :return: Ease instance. Its valid attribute is False if authentication failed
+        """
+        key = EaseManager.key(user, region)
+        with self.lock:
+            if key in self.clients:
+                return self.clients[key]
+        ease = Ease(user, pw, region, transport=self.transport, **kwargs)
+        with self.lock:
+            return self.clients.setdefault(key, ease)
+
+    def add_clients(self, credentials, region='default', **kwargs):
+        """
+        Authenticates many orgs at once
+
+        :param credentials: List of (user, password) tuples, or of (user, password, region) tuples
+        :param region: Optional. Region for the tuples that do not have one
+        :param kwargs: Optional. Any other Ease arguments
+        :return: Dict of user to Ease instance
+        """
+        def connect(cred):
+            return EaseManager.client(self, cred[0], cred[1], cred[2] if len(cred) > 2 else region, **kwargs)
+
+        return dict((cred[0], ease) for cred, ease in imap_unordered(connect, credentials, self.workers))
+
+    def run(self, func, clients=None):
+        """
+        Calls func once per client, for up to workers clients at the same time
+
+        :param func: Function taking an Ease instance. For example: lambda ease: ease.app.list()
+        :param clients: Optional. List of Ease instances. Defaults to every valid client of the manager
+        :return: List of (Ease instance, what func returned for it) tuples, in the order they finished
+        """
+        if clients is None:
+            with self.lock:
+                clients = [i for i in self.clients.values() if i.valid]
+        return list(imap_unordered(func, clients, self.workers))
+
+    def remove(self, user, region='default'):
+        """
+        Drops the client for user and region. The shared connection pools stay open for the other clients
+        """
+        with self.lock:
+            self.clients.pop(EaseManager.key(user, region), None)
+
+    @staticmethod
+    def key(user, region):
+        """
+        :return: Key of the client in clients. A region dict is keyed by its Python Web Services URL
+        """
+        return user, region['Python Web Services'] if isinstance(region, dict) else region
@@ -1,28 +1,40 @@
 # coding=utf-8
-import json
-import time
-import datetime
+import os
+import codec
+import threading
 import publishing
-from helpers import response_check, display_options
+import transfer
+from watcher import JobWatcher
+from concurrency import imap_unordered
+from streaming import iter_pages
+from cache import cached, invalidate
+from helpers import response_check, display_options, read_json, write_json
 
 
 class Apps:
-    def __init__(self, py_session, php_session, php_payload, region):
+    def __init__(self, py_session, php_session, rpc, region, cache=None, publish=None):
+        """
+        :param publish: Optional. Publish instance to upload and update apps with. A new one is made if not given
+        """
         self.session = py_session
-        self.publish = publishing.Publish(php_session, php_payload, py_session, region)
+        self.cache = cache
+        self.watcher = JobWatcher(apps=self)
+        self.publish = publish or publishing.Publish(php_session, rpc, py_session, region, cache)
         self.base = '{}/v1/applications'.format(region['Python Web Services'])
 
-    def list(self):
+    @cached('apps.list')
+    def list(self, stream=False):
         """
         GET /applications
         List application data about all the native applications stored in the EASE database for the authenticated
         user’s organization.
 
+        :param stream: Optional. True to parse the response as it is read and only decode the list. See response_check()
         :return: Dict with key:value pairs of the app psk and it's metadata. For example: {123:{METADATA}}
         """
         url = self.base
-        r = self.session.get(url)
-        resp = response_check(r, 'applications')
+        r = self.session.get(url, stream=stream)
+        resp = response_check(r, 'applications', stream=stream)
         # if resp['status'] == 200:
         #     app_data = {}
         #     for i in resp['resp']:
@@ -30,12 +42,24 @@ class Apps:
         #     resp['resp'] = app_data
         return resp
 
+    def iter_list(self):
+        """
+        Same as list(), but yields each app's metadata as it is read from the response instead of loading the whole
+        list first. Not cached
+
+        :return: Generator of dicts of app metadata
+        :raises ResponseError: If the request fails
+        """
+        return iter_pages(self.session, self.base, 'applications')
+
+    @cached('apps.details')
     def get_details(self, psk):
         """
         GET /applications/<app_psk>
         List data for a specific app
 
         :param psk: Unique ID of the app
+        :param refresh: Optional. If True the cached response, if any, is ignored and replaced
         :return: Returns dict of metadata about the specified application. Specify the app with app_psk.
         """
         url = '{}/{}'.format(self.base, str(psk))
@@ -43,6 +67,29 @@ class Apps:
         resp = response_check(r, 'application')
         return resp
 
+    def iter_details(self, psks, workers=8, refresh=False):
+        """
+        Fetches details for many apps at once over the shared session. Results are yielded as each request
+        finishes, not in the order of psks.
+
+        :param psks: Iterable of app psks
+        :param workers: Number of requests to have in flight at the same time
+        :param refresh: Optional. If True cached responses are ignored
+        :return: Generator of (psk, {'status', 'result'}) tuples
+        """
+        return imap_unordered(lambda psk: self.get_details(psk, refresh=refresh), psks, workers)
+
+    def get_details_many(self, psks, workers=8, refresh=False):
+        """
+        Same as get_details() but for a list of apps. Requests are sent concurrently.
+
+        :param psks: Iterable of app psks
+        :param workers: Number of requests to have in flight at the same time
+        :param refresh: Optional. If True cached responses are ignored
+        :return: Dict keyed by psk. Each value is the {'status', 'result'} dict get_details() would have returned
+        """
+        return dict(Apps.iter_details(self, psks, workers, refresh))
+
     def add_screenshot(self, psk, form, slot):
         """
         POST /applications/<app_psk>/screenshots/[phone/tablet]/<slot>
@@ -155,60 +202,121 @@ class Apps:
             resp['result'] = app_data
         return resp
 
-    def download(self, psk, file_name=False, status=False):
+    def download(self, psk, file_name=False, status=False, chunk_size=transfer.CHUNK_SIZE, segments=4, progress=None,
+                 checksum=None):
         """
         GET /downloads/direct/applications/<app_id>
-        Download the Application's Binary File
+        Download the Application's Binary File. The file is written to file_name + '.part' until it is complete, so
+        calling download again after a failure resumes instead of starting over. If the download server supports
+        Range requests, large files are fetched as several segments in parallel.
 
         :param psk: Unique ID of the app. Returned by list() or get_details() as "direct_download_binary_url"
         :param file_name: Path to save file to. If not passed, file will save in CWD with default filename
         :param status: Boolean that controls whether or not the download shows a status bar
+        :param chunk_size: Optional. Number of bytes read from the network per write
+        :param segments: Optional. Maximum number of parallel range requests. Use 1 to always download in one stream
+        :param progress: Optional. Function called with (bytes_done, bytes_total) as the download progresses
+        :param checksum: Optional. Tuple of (hashlib algorithm name, hex digest) the finished file must match
         :return: True False for download success/
         """
-        app_details = Apps.get_details(self, psk)['result']
+        app_details = Apps.get_details(self, psk)
+        if app_details['status'] != 200:
+            return app_details
+        app_details = app_details['result']
         if not file_name:
-            file_name = app_details['name'].replace(' ', '_')
-            if app_details['operating_system'] == 1:
-                file_name += '.ipa'
-            elif app_details['operating_system'] in [102, 103, 104, 105]:
-                file_name += '.apk'
-            elif app_details['operating_system'] in [205, 206, 207]:
-                file_name += '.zip'
-            elif app_details['operating_system'] == 401:
-                file_name += '.xap'
-
-        dl_url = self.session.get(app_details['direct_download_binary_url'], allow_redirects=True)
-        dl = self.session.get(dl_url.url, stream=True)
-        # Removed the status bar for now as it seems our fdownload server does not return anything about file size
-        # prior to actually downloading the file
-
-        # if status:
-        #     file_size = int(dl.headers["content-length"])
-        #     file_size_dl = 0
-        #     last = 0
-        #     print '-' * (len(file_name) + 24)
-        #     print file_name, '   '
-
-        with open(file_name, 'wb') as f:
-            for chunk in dl.iter_content(4096):
-                f.write(chunk)
-                # if status:
-                #     file_size_dl += 4096
-                #     dl_status = int(float(file_size_dl) / float(file_size) * 100)
-                #     if dl_status % 5 == 0:
-                #         if dl_status != last:
-                #             sys.stdout.write('#')
-                #             sys.stdout.flush()
-                #             last = int(dl_status)
-
-        result = {'status': dl.status_code}
-        if dl.status_code == 200:
-            result['result'] = file_name
-        else:
-            result['result'] = 'Failed'
+            file_name = Apps.binary_name(app_details)
+
+        if status and not progress:
+            progress = transfer.print_progress
 
+        result = transfer.download_file(self.session, app_details['direct_download_binary_url'], file_name,
+                                        chunk_size, segments, progress, checksum)
         return result
 
+    @staticmethod
+    def binary_name(app_details):
+        """
+        :param app_details: Dict of app metadata from list() or get_details()
+        :return: Default file name for the app's binary, based on the app name and operating system
+        """
+        file_name = app_details['name'].replace(' ', '_')
+        if app_details['operating_system'] == 1:
+            file_name += '.ipa'
+        elif app_details['operating_system'] in [102, 103, 104, 105]:
+            file_name += '.apk'
+        elif app_details['operating_system'] in [205, 206, 207]:
+            file_name += '.zip'
+        elif app_details['operating_system'] == 401:
+            file_name += '.xap'
+        return file_name
+
+    def export(self, dest_dir, psks=None, workers=4, max_bytes_per_sec=None, manifest='manifest.json',
+               chunk_size=transfer.CHUNK_SIZE, segments=1):
+        """
+        Downloads the binaries of many apps into dest_dir at the same time. Every file saved is recorded in a
+        manifest in dest_dir, and apps whose version has not changed since it was recorded are skipped on the next
+        run.
+
+        :param dest_dir: Directory to save the binaries in. Files are named <psk>_<default file name>
+        :param psks: Optional. List of app psks to export. If not passed, every app returned by list() is exported
+        :param workers: Number of binaries to download at the same time
+        :param max_bytes_per_sec: Optional. Limit for the combined download rate of all workers
+        :param manifest: File name of the manifest, relative to dest_dir
+        :param chunk_size: Optional. Number of bytes read from the network per write
+        :param segments: Optional. Parallel range requests per binary
+        :return: Dict with the status and, as result, a dict of psk to download result. The psks are strings, as in the
+            manifest. Skipped apps have a status of 304. If psks is not passed and the app list can't be fetched, the
+            list() response is returned instead
+        """
+        results = {}
+        if psks is None:
+            resp = Apps.list(self)
+            if resp['status'] != 200:
+                return resp
+            apps = resp['result']
+        else:
+            apps = []
+            for psk, resp in Apps.iter_details(self, psks, workers):
+                if resp['status'] == 200:
+                    apps.append(resp['result'])
+                else:
+                    results[str(psk)] = resp
+
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        manifest_path = os.path.join(dest_dir, manifest)
+        recorded = read_json(manifest_path, {})
+        lock = threading.Lock()
+        throttle = transfer.Throttle(max_bytes_per_sec) if max_bytes_per_sec else None
+
+        def fetch(app):
+            psk, version = str(app['psk']), Apps.version_key(app)
+            entry = recorded.get(psk)
+            if entry and entry['version'] == version and os.path.exists(entry['file']):
+                return {'status': 304, 'result': entry['file']}
+
+            file_name = os.path.join(dest_dir, '{}_{}'.format(psk, Apps.binary_name(app)))
+            resp = transfer.download_file(self.session, app['direct_download_binary_url'], file_name, chunk_size,
+                                          segments, throttle=throttle)
+            if resp['status'] == 200:
+                with lock:
+                    recorded[psk] = {'version': version, 'file': file_name}
+                    # Written after every file so an interrupted export keeps what it already finished
+                    write_json(manifest_path, recorded)
+            return resp
+
+        for app, resp in imap_unordered(fetch, apps, workers):
+            results[str(app['psk'])] = resp
+        return {'status': 200, 'result': results}
+
+    @staticmethod
+    def version_key(app_details):
+        # The version is a dict in the v1 API, fall back to the raw value for anything else
+        version = app_details.get('version')
+        if isinstance(version, dict):
+            return version.get('psk') or version.get('version_num')
+        return version
+
     def toggle(self, app_psk, state):
         """
         PUT /applications/<app_psk>
@@ -219,8 +327,10 @@ class Apps:
         :return: Dict of request status
         """
         url = '{}/{}'.format(self.base, app_psk)
-        r = self.session.put(url, data=json.dumps({'enabled': state}))
+        r = self.session.put(url, data=codec.dumps({'enabled': state}))
         resp = response_check(r, 'update_application_result')
+        invalidate(self.cache, 'apps.list')
+        invalidate(self.cache, 'apps.details', app_psk)
         return resp
 
     def delete(self, psk):
@@ -234,6 +344,10 @@ class Apps:
         url = '{}/{}'.format(self.base, psk)
         r = self.session.delete(url)
         resp = response_check(r, 'deleted_application')
+        invalidate(self.cache, 'apps.list')
+        invalidate(self.cache, 'apps.details', psk)
+        invalidate(self.cache, 'groups.list')
+        invalidate(self.cache, 'groups.apps')
         return resp
 
     def get_credentials(self, show=False):
@@ -245,16 +359,21 @@ class Apps:
         :param show: Optional, if set to True, you will select from a list of options
         :return: List of stored credentials for the
         """
+        resp = Apps.list_credentials(self)
+        if show and resp['status'] == 200:
+            choice = display_options(resp['result'], 'credential', 'description')
+            resp['result'] = choice['psk']
+        return resp
+
+    @cached('credentials')
+    def list_credentials(self):
         url = '{}credentials'.format(self.base)
         url = url.replace('applications', '')
         r = self.session.get(url)
         resp = response_check(r, 'credentials')
-        if show:
-            choice = display_options(resp['result'], 'credential', 'description')
-            resp['result'] = choice['psk']
         return resp
 
-    def sign(self, app_psk, cred_psk, async=False):
+    def sign(self, app_psk, cred_psk, async=False, timeout=None):
         """
         PUT /applications/<app_psk>/credentials/<credentials_psk>
         Signs an iOS or Android application using signing credentials that were previously stored in EASE for the
@@ -263,36 +382,28 @@ class Apps:
         :param app_psk: Unique ID for the App
         :param cred_psk: Unique ID for the credentials
         :param async: Optional. If passed, the sign call will be asyncronous and will not wait for the job to complete
-        before returning
+        before returning. Use watcher.watch_signing(app_psk) to wait for it later
+        :param timeout: Optional. Seconds to wait for signing to finish before giving up with a 408
         :return: dict of Signing Status
         """
         url = '{}/{}/credentials/{}'.format(self.base, app_psk, cred_psk)
         r = self.session.put(url)
         resp = response_check(r, 'signing_status')
-        if not async:
-            done_signing = False
-            while not done_signing:
-                resp = Apps.get_details(self, app_psk)
-                status = resp['result']['version']['signing_status']
-                if status == 'in_progress':
-                    ts = time.time()
-                    st = datetime.datetime.fromtimestamp(ts).strftime('%H:%M:%S')
-                    print "{} - Signing in progress...".format(st)
-                    time.sleep(10)
-                else:
-                    done_signing = True
-                    print 'Signing finished - {}'.format(status)
-                    if status != 'signed':
-                        resp['status'] = 500
-                    resp['result'] = resp['result']['version']['signing_status_details']
+        invalidate(self.cache, 'apps.details', app_psk)
+        invalidate(self.cache, 'wrapping.status', app_psk)
+        if not async and resp['status'] == 200:
+            resp = self.watcher.watch_signing(app_psk, timeout).wait()
 
         return resp
 
-    def update(self, app_psk, metadata, file_name=False):
+    def update(self, app_psk, metadata, file_name=False, chunk_size=None, progress=None):
         """
         :param app_psk: Unique ID for the app from publish.get_list()
         :param metadata: display metadata for EASE
         :param file_name: Optional parameter, if none is passed, function will just update metadata
+        :param chunk_size: Optional. Upload the file in chunks of this many bytes so an interrupted upload can be
+            resumed by calling update again with the same file
+        :param progress: Optional. Function called with (bytes_sent, bytes_total) as the file is sent
         :return:
         """
         current_data = self.publish.update(app_psk)
@@ -305,7 +416,9 @@ class Apps:
             if not transaction_id:
                 return data
             data['file_name'] = file_name
-            file_id = self.publish.upload(data)
+            if chunk_size:
+                data = self.publish.resume_transaction(data, app_psk)
+            file_id = self.publish.upload(data, progress, chunk_size=chunk_size)
             if file_id['status'] == 200:
                 data['file_id'] = file_id['result']
             else:
@@ -313,13 +426,35 @@ class Apps:
         if not metadata:
             metadata = data['EASEmetadata']
         pub = self.publish.publish(metadata, data)
+        if pub['status'] == 200 and data.get('file_hash'):
+            self.publish.upload_state.remove(data['file_hash'])
+        # app_psk here is the PHP appID, so there is no single details entry we can map it to
+        invalidate(self.cache, 'apps.list')
+        invalidate(self.cache, 'apps.details')
+        invalidate(self.cache, 'wrapping.version')
+        invalidate(self.cache, 'wrapping.status')
         return pub
 
-    def upload(self, file_path, metadata):
+    def upload(self, file_path, metadata, chunk_size=None, progress=None):
         """
         :param file_path: path to the file to upload on local disk
         :param metadata: required metadata for upload
+        :param chunk_size: Optional. Upload the file in chunks of this many bytes so an interrupted upload can be
+            resumed by calling upload again with the same file
+        :param progress: Optional. Function called with (bytes_sent, bytes_total) as the file is sent
         :return:
         """
-        upload_status = self.publish.add_new_app(file_path, metadata)
+        upload_status = self.publish.add_new_app(file_path, metadata, chunk_size, progress)
+        invalidate(self.cache, 'apps.list')
         return upload_status
+
+    def upload_many(self, items, create_workers=2, upload_workers=4, publish_workers=2, chunk_size=None):
+        """
+        Uploads many new apps at once. See Publish.publish_many()
+
+        :param items: List of (file_path, metadata) tuples
+        :return: List of dicts with the result for each item
+        """
+        report = self.publish.publish_many(items, create_workers, upload_workers, publish_workers, chunk_size)
+        invalidate(self.cache, 'apps.list')
+        return report
@@ -0,0 +1,126 @@
+# coding=utf-8
+import time
+import logging
+import threading
+from functools import wraps
+from collections import OrderedDict
+
+# Seconds a response stays valid, by endpoint. Anything not listed uses the cache's default ttl
+DEFAULT_TTLS = {
+    'apps.list': 60,
+    'apps.details': 60,
+    'groups.list': 120,
+    'groups.apps': 120,
+    'groups.members': 120,
+    'users.list': 120,
+    'credentials': 600,
+    'wrapping.version': 300,
+    'wrapping.policy': 300,
+    'wrapping.status': 60
+}
+
+
+class ResponseCache:
+    def __init__(self, ttl=60, ttls=None, max_entries=1024):
+        """
+        In memory cache of successful {'status', 'result'} responses for the read-only endpoints. Entries expire
+        after the ttl for their endpoint and the least recently used entry is evicted once max_entries is reached.
+
+        :param ttl: Default number of seconds an entry is valid for
+        :param ttls: Optional. Dict of endpoint name to ttl, overrides DEFAULT_TTLS. For example: {'apps.list': 10}
+        :param max_entries: Maximum number of responses to keep
+        """
+        self.ttl = ttl
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, key):
+        """
+        :param key: Tuple of the endpoint name followed by the call arguments
+        :return: Copy of the cached response dict, or None if it is missing or expired
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # Re-insert to mark as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return dict(entry[1])
+
+    def set(self, key, value):
+        ttl = self.ttls.get(key[0], self.ttl)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, dict(value))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *prefix):
+        """
+        Drops every entry whose key starts with prefix. invalidate('apps.details', 123) drops one app,
+        invalidate('apps.details') drops all of them.
+
+        :param prefix: Endpoint name optionally followed by call arguments
+        """
+        prefix = key_for(prefix[0], prefix[1:])
+        with self.lock:
+            for key in [k for k in self.entries if k[:len(prefix)] == prefix]:
+                del self.entries[key]
+        logging.debug('Cache invalidated {}'.format(prefix))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        :return: Dict with the keys: hits, misses, evictions, size
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.entries)}
+
+
+def key_for(endpoint, args):
+    # psks come back from the API as ints but are often passed in as strings
+    return (endpoint,) + tuple(str(i) for i in args)
+
+
+def cached(endpoint):
+    """
+    Decorator for connector methods whose response can be cached. Uses the connector's cache attribute and does
+    nothing if it is None. Callers can pass refresh=True to skip the lookup and store a fresh response.
+
+    :param endpoint: Name of the endpoint, used as the first part of the cache key and to look up its ttl
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            refresh = kwargs.pop('refresh', False)
+            cache = getattr(self, 'cache', None)
+            if cache is None:
+                return func(self, *args, **kwargs)
+
+            key = key_for(endpoint, args + tuple(sorted(kwargs.items())))
+            if not refresh:
+                resp = cache.get(key)
+                if resp is not None:
+                    return resp
+            resp = func(self, *args, **kwargs)
+            if resp['status'] == 200:
+                cache.set(key, resp)
+            return resp
+        return wrapper
+    return decorator
+
+
+def invalidate(cache, *prefix):
+    if cache is not None:
+        cache.invalidate(*prefix)
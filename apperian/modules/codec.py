@@ -0,0 +1,49 @@
+# coding=utf-8
+import json
+import logging
+
+# JSON libraries to use for request payloads and responses, fastest first. The standard library json module is used
+# if none of them are installed. pip install apperian[fast] installs the first one
+LIBRARIES = ['ujson', 'rapidjson', 'simplejson']
+
+
+def load(name):
+    """
+    :param name: Name of a module in LIBRARIES, or json
+    :return: Tuple of (name, dumps, loads) for the library, or None if it is not installed
+    """
+    try:
+        module = __import__(name)
+    except ImportError:
+        return None
+
+    if name == 'ujson':
+        # ujson escapes forward slashes by default, which the standard library does not
+        return name, lambda obj: module.dumps(obj, escape_forward_slashes=False), module.loads
+    return name, module.dumps, module.loads
+
+
+def select(names=None):
+    """
+    :param names: Optional. List of libraries to try, in order. Defaults to LIBRARIES
+    :return: Tuple of (name, dumps, loads) of the first one installed, or of the standard library json module
+    """
+    for name in names if names is not None else LIBRARIES:
+        lib = load(name)
+        if lib:
+            return lib
+    return 'json', json.dumps, json.loads
+
+
+def use(name):
+    """
+    Switches the library used by dumps() and loads(). Falls back to the standard library if it is not installed
+
+    :param name: Name of a module in LIBRARIES, or json
+    """
+    global NAME, dumps, loads
+    NAME, dumps, loads = select([name])
+    logging.debug('Using %s for json', NAME)
+
+
+NAME, dumps, loads = select()
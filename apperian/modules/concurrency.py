@@ -0,0 +1,66 @@
+# coding=utf-8
+
+
+class AsyncConnector:
+    def __init__(self, connector, pool):
+        """
+        Wraps one of the Ease connectors (Apps, Groups, Users, Publish, Wrapper) so that every public method is
+        submitted to a shared thread pool instead of blocking the caller. The pool size bounds how many requests
+        are in flight at once.
+
+        :param connector: Connector instance to wrap
+        :param pool: multiprocessing.pool.ThreadPool shared by all connectors of the session
+        """
+        self.connector = connector
+        self.pool = pool
+
+    def __getattr__(self, name):
+        attr = getattr(self.connector, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def submit(*args, **kwargs):
+            return self.pool.apply_async(attr, args, kwargs)
+
+        submit.__name__ = name
+        submit.__doc__ = attr.__doc__
+        return submit
+
+
+def new_pool(size):
+    """
+    :param size: Maximum number of calls that will run at the same time
+    :return: ThreadPool instance
+    """
+    # Imported on first use, multiprocessing is slow to import and most scripts never make a pool
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(size)
+
+
+def gather(results, timeout=None):
+    """
+    Wait for a list of pending calls and return their results in the same order
+
+    :param results: List of AsyncResult objects returned by an AsyncConnector method
+    :param timeout: Optional. Seconds to wait for each call
+    :return: List of {'status', 'result'} dicts
+    """
+    return [i.get(timeout) for i in results]
+
+
+def imap_unordered(func, items, workers=8):
+    """
+    Run func once for each item on a temporary thread pool and yield results as they complete
+
+    :param func: Function taking a single item
+    :param items: Iterable of items to pass to func
+    :param workers: Number of calls to run at the same time
+    :return: Generator of (item, func(item)) tuples in completion order
+    """
+    pool = new_pool(workers)
+    try:
+        for pair in pool.imap_unordered(lambda item: (item, func(item)), items):
+            yield pair
+    finally:
+        pool.terminate()
+        pool.join()
@@ -1,27 +1,49 @@
 # coding=utf-8
-import json
+import codec
+import threading
+from concurrency import imap_unordered
 from helpers import response_check
+from streaming import iter_pages
+from cache import cached, invalidate
 
 
 class Groups:
-    def __init__(self, session, region):
+    def __init__(self, session, region, cache=None):
         self.session = session
         self.region = region
-
-    def list(self):
+        self.cache = cache
+        # Reverse membership indexes of user psk and app psk to the set of their group psks. None until
+        # build_membership_index() is called
+        self.user_groups = None
+        self.app_groups = None
+        self.index_lock = threading.Lock()
+
+    @cached('groups.list')
+    def list(self, stream=False):
         """
         list of all the groups for the authenticated user’s organization. This list includes the number of users
         and number of applications belonging to each group.
 
+        :param stream: Optional. True to parse the response as it is read and only decode the list. See response_check()
         :return: List of dicts of the groups. Dict keys are: app_count, psk, user_count, name, description
 
         https://apidocs.apperian.com/v1/groups.html
         """
         url = '%s/v1/groups/' % self.region['Python Web Services']
-        r = self.session.get(url)
-        result = response_check(r, 'groups')
+        r = self.session.get(url, stream=stream)
+        result = response_check(r, 'groups', stream=stream)
         return result
 
+    def iter_list(self):
+        """
+        Same as list(), but yields each group as it is read from the response. Not cached
+
+        :return: Generator of dicts of the groups
+        :raises ResponseError: If the request fails
+        """
+        url = '%s/v1/groups/' % self.region['Python Web Services']
+        return iter_pages(self.session, url, 'groups')
+
     def add(self, data):
         """
         Adds a new group to the authenticated user’s organization.
@@ -32,25 +54,39 @@ class Groups:
         https://apidocs.apperian.com/v1/groups.html
         """
         url = '%s/v1/groups/' % self.region['Python Web Services']
-        payload = json.dumps(data)
+        payload = codec.dumps(data)
         r = self.session.post(url, data=payload)
         result = response_check(r, 'group')
+        invalidate(self.cache, 'groups.list')
         return result
 
-    def list_apps(self, group_psk):
+    @cached('groups.apps')
+    def list_apps(self, group_psk, stream=False):
         """
         Returns a list of the applications that are in the specified group.
 
         :param group_psk: Unique ID assigned by EASE to the group.
+        :param stream: Optional. True to parse the response as it is read and only decode the list. See response_check()
         :return: List of dicts. See API docs for dict keys
 
         https://apidocs.apperian.com/v1/groups.html
         """
         url = '{}/v1/groups/{}'.format(self.region['Python Web Services'], group_psk)
-        r = self.session.get(url)
-        result = response_check(r, 'applications')
+        r = self.session.get(url, stream=stream)
+        result = response_check(r, 'applications', stream=stream)
         return result
 
+    def iter_apps(self, group_psk):
+        """
+        Same as list_apps(), but yields each app as it is read from the response. Not cached
+
+        :param group_psk: Unique ID assigned by EASE to the group.
+        :return: Generator of dicts
+        :raises ResponseError: If the request fails
+        """
+        url = '{}/v1/groups/{}'.format(self.region['Python Web Services'], group_psk)
+        return iter_pages(self.session, url, 'applications')
+
     def add_apps(self, group_psk, app_list):
         """
         Adds applications to a specified group. Specify apps by app_psk.
@@ -60,9 +96,13 @@ class Groups:
         :return: Dict of lists. Dict keys are: apps_added, apps_failed
         """
         url = '{}/v1/groups/{}/applications'.format(self.region['Python Web Services'], group_psk)
-        payload = json.dumps({"app_psk": app_list})
+        payload = codec.dumps({"app_psk": app_list})
         r = self.session.post(url, data=payload)
         result = response_check(r, 'response')
+        invalidate(self.cache, 'groups.list')
+        invalidate(self.cache, 'groups.apps', group_psk)
+        if result['status'] == 200:
+            Groups.index_update(self, self.app_groups, [group_psk], result['result'].get('apps_added', app_list), True)
         return result
 
     def delete_apps(self, group_psk, app_list):
@@ -74,25 +114,43 @@ class Groups:
         :return: Dict of lists. Dict keys are: apps_removed, apps_failed
         """
         url = '{}/v1/groups/{}/applications'.format(self.region['Python Web Services'], group_psk)
-        payload = json.dumps({"app_psk": app_list})
+        payload = codec.dumps({"app_psk": app_list})
         r = self.session.delete(url, data=payload)
         result = response_check(r, 'response')
+        invalidate(self.cache, 'groups.list')
+        invalidate(self.cache, 'groups.apps', group_psk)
+        if result['status'] == 200:
+            Groups.index_update(self, self.app_groups, [group_psk], result['result'].get('apps_removed', app_list),
+                                False)
         return result
 
-    def list_members(self, group_psk):
+    @cached('groups.members')
+    def list_members(self, group_psk, stream=False):
         """
         Lists users who are members of a specified group.
 
         :param group_psk: Unique ID assigned by EASE to the group.
+        :param stream: Optional. True to parse the response as it is read and only decode the list. See response_check()
         :return: List of Dicts. See API docs for dict keys
 
         https://apidocs.apperian.com/v1/groups.html
         """
         url = '{}/v1/groups/{}/users/'.format(self.region['Python Web Services'], group_psk)
-        r = self.session.get(url)
-        result = response_check(r, 'users_in_group')
+        r = self.session.get(url, stream=stream)
+        result = response_check(r, 'users_in_group', stream=stream)
         return result
 
+    def iter_members(self, group_psk):
+        """
+        Same as list_members(), but yields each user as it is read from the response. Not cached
+
+        :param group_psk: Unique ID assigned by EASE to the group.
+        :return: Generator of dicts
+        :raises ResponseError: If the request fails
+        """
+        url = '{}/v1/groups/{}/users/'.format(self.region['Python Web Services'], group_psk)
+        return iter_pages(self.session, url, 'users_in_group')
+
     def add_member(self, user_psk, groups):
         """
         Adds a specified user to a list of groups. Specify groups by group_psk.
@@ -104,9 +162,13 @@ class Groups:
         https://apidocs.apperian.com/v1/groups.html
         """
         url = '{}/v1/groups/users/{}'.format(self.region['Python Web Services'], user_psk)
-        payload = json.dumps({"group_psk": groups})
+        payload = codec.dumps({"group_psk": groups})
         r = self.session.get(url, data=payload)
         result = response_check(r, 'response')
+        invalidate(self.cache, 'groups.list')
+        invalidate(self.cache, 'groups.members')
+        if result['status'] == 200:
+            Groups.index_update(self, self.user_groups, result['result'].get('added_groups', groups), [user_psk], True)
         return result
 
     def add_users(self, users, groups):
@@ -143,9 +205,14 @@ class Groups:
         :return: Dict of lists. Dict keys are: users_failed, users_added
         """
         url = '{}/v1/groups/{}/users'.format(self.region['Python Web Services'], group_psk)
-        payload = json.dumps({"user_psk": user_list})
+        payload = codec.dumps({"user_psk": user_list})
         r = self.session.get(url, data=payload)
         result = response_check(r, 'response')
+        invalidate(self.cache, 'groups.list')
+        invalidate(self.cache, 'groups.members', group_psk)
+        if result['status'] == 200:
+            Groups.index_update(self, self.user_groups, [group_psk], result['result'].get('users_added', user_list),
+                                True)
         return result
 
     def remove_members(self, group_psk, user_list):
@@ -157,9 +224,14 @@ class Groups:
         :return: Dict of lists. Dict keys are: users_failed, users_removed
         """
         url = '{}/v1/groups/{}/users'.format(self.region['Python Web Services'], group_psk)
-        payload = json.dumps({"user_psk": user_list})
+        payload = codec.dumps({"user_psk": user_list})
         r = self.session.delete(url, data=payload)
         result = response_check(r, 'response')
+        invalidate(self.cache, 'groups.list')
+        invalidate(self.cache, 'groups.members', group_psk)
+        if result['status'] == 200:
+            Groups.index_update(self, self.user_groups, [group_psk], result['result'].get('users_removed', user_list),
+                                False)
         return result
 
     def update(self, group_psk, data):
@@ -171,9 +243,10 @@ class Groups:
         :return: Dict with updated metadata. Dict keys are: psk, name, description
         """
         url = '{}/v1/groups/{}'.format(self.region['Python Web Services'], group_psk)
-        payload = json.dumps({data})
+        payload = codec.dumps(data)
         r = self.session.put(url, data=payload)
         result = response_check(r, 'group')
+        invalidate(self.cache, 'groups.list')
         return result
 
     def delete(self, group_psk):
@@ -186,4 +259,93 @@ class Groups:
         url = '{}/v1/groups/{}'.format(self.region['Python Web Services'], group_psk)
         r = self.session.delete(url)
         result = response_check(r, 'deleted_group')
+        invalidate(self.cache, 'groups.list')
+        invalidate(self.cache, 'groups.apps', group_psk)
+        invalidate(self.cache, 'groups.members', group_psk)
+        if result['status'] == 200:
+            with self.index_lock:
+                for index in [self.user_groups, self.app_groups]:
+                    for group_set in (index or {}).values():
+                        group_set.discard(str(group_psk))
         return result
+
+    def build_membership_index(self, workers=8):
+        """
+        Fetches the members and apps of every group concurrently and builds the reverse indexes used by
+        groups_for_user() and groups_for_app(). They are kept up to date by add_member, add_members, remove_members,
+        add_apps, delete_apps and delete. Call this again to pick up changes made outside of this session.
+
+        :param workers: Number of groups to fetch at once
+        :return: Dict with the status and, as result, a dict with the number of groups, users and apps indexed
+        """
+        groups = Groups.list(self, refresh=True)
+        if groups['status'] != 200:
+            return groups
+
+        def fetch(psk):
+            return Groups.list_members(self, psk, refresh=True), Groups.list_apps(self, psk, refresh=True)
+
+        user_groups, app_groups = {}, {}
+        for psk, (members, apps) in imap_unordered(fetch, [i['psk'] for i in groups['result']], workers):
+            for resp in [members, apps]:
+                if resp['status'] != 200:
+                    return resp
+            for user in members['result']:
+                user_groups.setdefault(str(user['psk']), set()).add(str(psk))
+            for app in apps['result']:
+                app_groups.setdefault(str(app['psk']), set()).add(str(psk))
+
+        with self.index_lock:
+            self.user_groups, self.app_groups = user_groups, app_groups
+        return {'status': 200, 'result': {'groups': len(groups['result']), 'users': len(user_groups),
+                                          'apps': len(app_groups)}}
+
+    def groups_for_user(self, user_psk):
+        """
+        Looks the user up in the reverse membership index, building it first if needed
+
+        :param user_psk: Unique ID of the user
+        :return: Dict with the status and, as result, a sorted list of the psks of the groups the user is in
+        """
+        return Groups.index_lookup(self, 'user_groups', user_psk)
+
+    def groups_for_app(self, app_psk):
+        """
+        Looks the app up in the reverse membership index, building it first if needed
+
+        :param app_psk: Unique ID of the app
+        :return: Dict with the status and, as result, a sorted list of the psks of the groups the app is in
+        """
+        return Groups.index_lookup(self, 'app_groups', app_psk)
+
+    def index_lookup(self, index_name, psk):
+        if getattr(self, index_name) is None:
+            resp = Groups.build_membership_index(self)
+            if resp['status'] != 200:
+                return resp
+        with self.index_lock:
+            return {'status': 200, 'result': sorted(getattr(self, index_name).get(str(psk), ()))}
+
+    def index_update(self, index, group_psks, member_psks, added):
+        """
+        Adds or removes every pair of group and member in a reverse index. Does nothing if the index is not built
+
+        :param index: self.user_groups or self.app_groups
+        :param group_psks: List, or comma separated string, of group psks
+        :param member_psks: List, or comma separated string, of user or app psks
+        :param added: True to add the pairs, False to remove them
+        """
+        if index is None:
+            return
+        if not isinstance(group_psks, list):
+            group_psks = str(group_psks).split(',')
+        if not isinstance(member_psks, list):
+            member_psks = str(member_psks).split(',')
+        with self.index_lock:
+            for member in member_psks:
+                groups = index.setdefault(str(member).strip(), set())
+                for group in group_psks:
+                    if added:
+                        groups.add(str(group).strip())
+                    else:
+                        groups.discard(str(group).strip())
@@ -1,8 +1,22 @@
+import os
+import json
+import codec
 import logging
 
 php_token = "e(PujgdDx0s3kScfctYqCBug{plur1bus^unum})"
 
 
+class ResponseError(Exception):
+    def __init__(self, status, result):
+        """
+        Raised by the iter_* generators, which cannot return a status dict. status and result are what the matching
+        list method would have returned
+        """
+        Exception.__init__(self, '{}: {}'.format(status, result))
+        self.status = status
+        self.result = result
+
+
 def display_options(data, msg, narrow=False):
     valid, choice = False, ''
     print 'Possible Regions:'
@@ -32,31 +46,113 @@ def display_options(data, msg, narrow=False):
     return data[choice]
 
 
-def response_check(requests_obj, *args):
-    result = {'status': requests_obj.status_code}
-    logging.debug('status_code = {}'.format(result['status']))
+def response_check(requests_obj, *args, **kwargs):
+    """
+    :param requests_obj: requests.Response
+    :param args: Keys to walk down in the response json
+    :param stream: Optional. If True, the body is parsed as it is read and only the value at args is decoded.
+        Everything else in the document is skipped over. Use with requests made with stream=True. This holds far
+        less of a large response in memory, but decodes with the standard library json module instead of codec,
+        so it is slower when a faster library is installed
+    :return: Dict with the status and result
+    """
+    logging.debug('status_code = %s', requests_obj.status_code)
+    if kwargs.get('stream') and args:
+        return stream_check(requests_obj, *args)
     try:
-        message = requests_obj.json()
-        if 'error' in message.keys():
-            logging.debug('Error found in response keys:')
-            logging.debug(message)
-            result['status'] = 401
-            message = message['error']
-        else:
-            if args:
-                try:
-                    for arg in args:
-                        message = message[arg]
-                except KeyError:
-                    logging.debug('Expected key not present in response')
-                    logging.debug('Keys in response json are: {}'.format(message.keys()))
-                    result['status'] = 500
+        message = codec.loads(requests_obj.content)
     except ValueError:
         logging.debug('Unable to get json from  response')
-        logging.debug(requests_obj.text)
-        result['status'] = 500
-        message = requests_obj.text
+        logging.debug('%s', requests_obj.text)
+        result = {'status': 500, 'result': requests_obj.text}
+        logging.debug('%s', result)
+        return result
+
+    return message_check(message, requests_obj.status_code, *args)
+
+
+def stream_check(requests_obj, *args):
+    # Imported here since streaming needs ResponseError from this module
+    from streaming import JSONStream, CHUNK_SIZE
+
+    result = {'status': requests_obj.status_code}
+    stream = JSONStream(requests_obj.iter_content(CHUNK_SIZE))
+    try:
+        JSONStream.find(stream, *args)
+        if JSONStream.peek(stream) == u'[':
+            result['result'] = list(JSONStream.items(stream))
+        else:
+            result['result'] = JSONStream.value(stream)
+    except ResponseError as e:
+        logging.debug('Expected key not present in response or error found in response: %s', e.result)
+        result['status'], result['result'] = e.status, e.result
+    except ValueError as e:
+        logging.debug('Unable to get json from response: %s', e)
+        result['status'], result['result'] = 500, 'Unable to get json from response: {}'.format(e)
+    finally:
+        requests_obj.close()
+    logging.debug('%s', result)
+    return result
+
+
+def message_check(message, status, *args):
+    """
+    Does the checks of response_check() on a response body that has already been parsed. Used for the parts of a
+    JSON-RPC batch response.
+
+    :param message: Parsed json of the response
+    :param status: HTTP status code of the response
+    :param args: Keys to walk down in message
+    :return: Dict with the status and result
+    """
+    result = {'status': status}
+    if 'error' in message.keys():
+        logging.debug('Error found in response keys:')
+        logging.debug('%s', message)
+        result['status'] = 401
+        message = message['error']
+    else:
+        if args:
+            try:
+                for arg in args:
+                    message = message[arg]
+            except KeyError:
+                logging.debug('Expected key not present in response')
+                logging.debug('Keys in response json are: %s', message.keys())
+                result['status'] = 500
 
     result['result'] = message
-    logging.debug(result)
+    logging.debug('%s', result)
     return result
+
+
+def write_json(path, data, mode=None):
+    """
+    Writes data to path as json through a temporary file, so a crash mid-write never leaves a truncated file behind
+
+    :param mode: Optional. Permissions to create the file with, for example 0o600 to keep it private to the user
+    """
+    tmp = path + '.tmp'
+    if mode is None:
+        f = open(tmp, 'w')
+    else:
+        # A temporary file left by a crash may have other permissions, and os.open only applies mode when creating
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        f = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'w')
+    with f:
+        json.dump(data, f, indent=4)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+
+
+def read_json(path, default=None):
+    """
+    :return: Parsed contents of path, or default if it is missing or not valid json
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
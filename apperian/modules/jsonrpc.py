@@ -0,0 +1,152 @@
+# coding=utf-8
+import codec
+import logging
+import itertools
+from helpers import response_check, message_check
+from streaming import iter_response
+
+# JSON-RPC error codes a server answers a batch with when it only accepts single calls: Parse error, Invalid Request
+# and Method not found
+BATCH_ERROR_CODES = (-32700, -32600, -32601)
+
+
+class RPC:
+    def __init__(self, session, url, token='', authenticate=None):
+        """
+        Sends calls to the PHP Web Services. Every call gets its own payload with a new id, so nothing is shared
+        between calls and the connectors that use it can run from several threads at once.
+
+        :param session: requests.Session for the PHP Web Services
+        :param url: URL of ease.interface.php for the region
+        :param token: Auth token, sent in the params of every call
+        :param authenticate: Optional. Function taking the token a call was sent with, or None before the first call.
+            It authenticates if that token is missing or stale, sets self.token and returns True if it is usable
+        """
+        self.session = session
+        self.url = url
+        self.token = token
+        self.authenticate = authenticate
+        # Set to False the first time the server says it does not support batches, so later batches go straight to
+        # single calls
+        self.batching = True
+        # next() on itertools.count is atomic, so ids stay unique across threads
+        self.ids = itertools.count(1)
+
+    def payload(self, method, params=None):
+        """
+        :param method: JSON-RPC method name. For example: com.apperian.eas.apps.getlist
+        :param params: Optional. Dict of params for the method. The token is added automatically, and replaces the
+            value of pythonAuthToken if params has one
+        :return: Dict of the JSON-RPC request
+        """
+        call_params = {'token': self.token}
+        if params:
+            call_params.update(params)
+            if 'pythonAuthToken' in params:
+                # Filled in at send time so a call retried after authenticating again sends the new token
+                call_params['pythonAuthToken'] = self.token
+        return {'id': next(self.ids), 'apiVersion': '1.0', 'method': method, 'jsonrpc': '2.0', 'params': call_params}
+
+    def call(self, method, params=None, *args, **kwargs):
+        """
+        :param method: JSON-RPC method name
+        :param params: Optional. Dict of params for the method
+        :param args: Keys to walk down in the response, same as response_check()
+        :param stream: Optional. Stream the response and only decode the value at args. See response_check()
+        :return: Dict with the status and result of the call
+        """
+        stream = kwargs.get('stream', False)
+        token = RPC.ensure_token(self)
+        r = self.session.post(self.url, data=codec.dumps(RPC.payload(self, method, params)), stream=stream)
+        resp = response_check(r, *args, stream=stream)
+        if resp['status'] == 401 and self.authenticate and self.authenticate(token):
+            logging.debug('Call rejected, retrying %s with a new token', method)
+            r = self.session.post(self.url, data=codec.dumps(RPC.payload(self, method, params)), stream=stream)
+            resp = response_check(r, *args, stream=stream)
+        return resp
+
+    def ensure_token(self):
+        """
+        :return: Token to send, after authenticating if there isn't one yet
+        """
+        if self.authenticate:
+            self.authenticate(None)
+        return self.token
+
+    def iter_call(self, method, params=None, *args):
+        """
+        Same as call() for methods that return a list, but streams the response and yields the items of the list
+        as they are read
+
+        :param args: Keys to walk down in the response to get to the list
+        :return: Generator of the items of the list
+        :raises ResponseError: If the call fails
+        """
+        RPC.ensure_token(self)
+        r = self.session.post(self.url, data=codec.dumps(RPC.payload(self, method, params)), stream=True)
+        return iter_response(r, *args)
+
+    def batch(self, calls, size=50):
+        """
+        Sends many calls as JSON-RPC 2.0 batches of up to size calls per request, and matches the responses back by
+        id. If the server does not accept batches, the calls are sent one at a time instead.
+
+        :param calls: List of tuples of (method, params, key, key, ...). The keys are the same as the args of call()
+        :param size: Maximum number of calls per request
+        :return: List of dicts with the status and result of each call, in the same order as calls
+        """
+        results = []
+        for start in range(0, len(calls), size):
+            chunk = calls[start:start + size]
+            resp = RPC.send_batch(self, chunk) if self.batching else None
+            if resp is None:
+                resp = [RPC.call(self, *i) for i in chunk]
+            results.extend(resp)
+        return results
+
+    @staticmethod
+    def batch_unsupported(message):
+        """
+        :param message: Parsed json of a reply to a batch that is not a list, or None if it was not json
+        :return: True if the reply says the server cannot handle batches, rather than that this one failed, for
+            example on a timeout or an expired token
+        """
+        if not isinstance(message, dict) or not isinstance(message.get('error'), dict):
+            return False
+        error = message['error']
+        return error.get('code') in BATCH_ERROR_CODES or u'batch' in unicode(error.get('message', '')).lower()
+
+    def send_batch(self, calls, retry_auth=True):
+        """
+        :param retry_auth: Optional. If True, calls rejected with an error are sent once more after authenticating
+            again, when authenticate() says the token was stale. Same as call()
+        :return: List of results, or None if the server did not answer with a batch response
+        """
+        token = RPC.ensure_token(self)
+        payloads = [RPC.payload(self, i[0], i[1] if len(i) > 1 else None) for i in calls]
+        r = self.session.post(self.url, data=codec.dumps(payloads))
+        try:
+            message = codec.loads(r.content)
+        except ValueError:
+            message = None
+        if not isinstance(message, list):
+            logging.debug('Batch rejected, falling back to single calls: {}'.format(r.text[:200]))
+            if RPC.batch_unsupported(message):
+                self.batching = False
+            return None
+
+        by_id = dict((i.get('id'), i) for i in message if isinstance(i, dict))
+        results = []
+        for payload, call in zip(payloads, calls):
+            if payload['id'] in by_id:
+                results.append(message_check(by_id[payload['id']], r.status_code, *call[2:]))
+            else:
+                results.append({'status': 500, 'result': 'No response for call {}'.format(payload['id'])})
+
+        rejected = [n for n, resp in enumerate(results) if resp['status'] == 401]
+        if rejected and retry_auth and self.authenticate and self.authenticate(token):
+            logging.debug('Batch calls rejected, retrying %s of them with a new token', len(rejected))
+            retried = RPC.send_batch(self, [calls[n] for n in rejected], False)
+            for n, resp in zip(rejected, retried or []):
+                results[n] = resp
+        return results
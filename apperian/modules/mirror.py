@@ -0,0 +1,232 @@
+# coding=utf-8
+import codec
+import logging
+import sqlite3
+import threading
+from concurrency import imap_unordered
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS apps (psk TEXT PRIMARY KEY, name TEXT, bundle_id TEXT, signature TEXT, data TEXT);
+CREATE TABLE IF NOT EXISTS users (psk TEXT PRIMARY KEY, id TEXT, email TEXT, signature TEXT, data TEXT);
+CREATE TABLE IF NOT EXISTS groups (psk TEXT PRIMARY KEY, name TEXT, signature TEXT, data TEXT);
+CREATE TABLE IF NOT EXISTS group_apps (group_psk TEXT, app_psk TEXT, PRIMARY KEY (group_psk, app_psk));
+CREATE TABLE IF NOT EXISTS group_users (group_psk TEXT, user_psk TEXT, PRIMARY KEY (group_psk, user_psk));
+CREATE INDEX IF NOT EXISTS apps_name ON apps (name);
+CREATE INDEX IF NOT EXISTS apps_bundle_id ON apps (bundle_id);
+CREATE INDEX IF NOT EXISTS users_id ON users (id);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE INDEX IF NOT EXISTS groups_name ON groups (name);
+CREATE INDEX IF NOT EXISTS group_apps_app ON group_apps (app_psk);
+CREATE INDEX IF NOT EXISTS group_users_user ON group_users (user_psk);
+'''
+
+# Table name to the function that picks its indexed columns out of a record, in the same order as SCHEMA
+COLUMNS = {
+    'apps': lambda i: (i.get('name'), i.get('bundle_id') or i.get('bundleID')),
+    'users': lambda i: (i.get('id'), i.get('email')),
+    'groups': lambda i: (i.get('name'),)
+}
+
+
+class OrgMirror:
+    def __init__(self, apps, users, groups, path=':memory:', workers=8):
+        """
+        Local SQLite copy of the org's apps, users and groups, and of which apps and users are in each group, so
+        questions like "which groups contain app X" are answered without any requests. Call refresh() to fill it
+        and again later to pick up changes.
+
+        :param apps: Apps instance
+        :param users: Users instance
+        :param groups: Groups instance
+        :param path: Optional. Database file to keep the mirror in between runs. Defaults to memory only
+        :param workers: Number of group memberships to fetch at once
+        """
+        self.apps = apps
+        self.users = users
+        self.groups = groups
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def refresh(self, full=False):
+        """
+        Fetches the app, user and group lists and only writes the records that changed since the last refresh.
+        Records are compared by modified_date when they have one, otherwise by their full contents. Group
+        memberships are only fetched again for groups whose details, including user_count and app_count, changed.
+
+        :param full: Optional. If True, fetch the memberships of every group, for changes that keep the counts
+        :return: Dict with the status and, as result, a dict of table name to the number of records added,
+            updated and removed
+        """
+        fetches = {'apps': self.apps.list, 'users': self.users.list, 'groups': self.groups.list}
+        lists = dict(imap_unordered(lambda name: fetches[name](refresh=True), sorted(fetches), 3))
+        for name in sorted(lists):
+            if lists[name]['status'] != 200:
+                return lists[name]
+
+        result, changed = {}, {}
+        with self.lock:
+            for name in sorted(lists):
+                result[name], changed[name] = OrgMirror.sync_table(self, name, lists[name]['result'])
+            groups = [row[0] for row in self.db.execute('SELECT psk FROM groups')] if full else list(changed['groups'])
+        memberships = OrgMirror.fetch_memberships(self, groups, changed['groups'])
+        if memberships['status'] != 200:
+            return memberships
+        result['memberships'] = memberships['result']
+        return {'status': 200, 'result': result}
+
+    def sync_table(self, table, records):
+        """
+        Groups are stored without their signature. fetch_memberships() sets it once the group's apps and users are
+        stored, so if that never happens the next refresh fetches them again
+
+        :return: Tuple of (dict of added, updated and removed counts, dict of psk to signature of the added and
+            updated records)
+        """
+        stored = dict(self.db.execute('SELECT psk, signature FROM {}'.format(table)))
+        seen, changed, added = set(), {}, 0
+        rows = []
+        for record in records:
+            psk = str(record['psk'])
+            seen.add(psk)
+            signature = record.get('modified_date') or codec.dumps(record)
+            if stored.get(psk) == signature:
+                continue
+            added += psk not in stored
+            changed[psk] = signature
+            rows.append((psk,) + COLUMNS[table](record) + (None if table == 'groups' else signature,
+                                                           codec.dumps(record)))
+
+        removed = [(i,) for i in stored if i not in seen]
+        with self.db:
+            if rows:
+                marks = ', '.join('?' * len(rows[0]))
+                self.db.executemany('INSERT OR REPLACE INTO {} VALUES ({})'.format(table, marks), rows)
+            self.db.executemany('DELETE FROM {} WHERE psk = ?'.format(table), removed)
+            if table == 'groups':
+                self.db.executemany('DELETE FROM group_apps WHERE group_psk = ?', removed)
+                self.db.executemany('DELETE FROM group_users WHERE group_psk = ?', removed)
+            else:
+                column = 'app_psk' if table == 'apps' else 'user_psk'
+                link = 'group_apps' if table == 'apps' else 'group_users'
+                self.db.executemany('DELETE FROM {} WHERE {} = ?'.format(link, column), removed)
+        logging.debug('Mirror %s: %s added, %s updated, %s removed', table, added, len(rows) - added, len(removed))
+        return {'added': added, 'updated': len(rows) - added, 'removed': len(removed)}, changed
+
+    def fetch_memberships(self, group_psks, signatures=None):
+        """
+        Replaces the stored apps and users of each group with fresh lists, fetched concurrently
+
+        :param group_psks: List of group psks
+        :param signatures: Optional. Dict of group psk to the signature to store along with its memberships
+        :return: Dict with the status and, as result, the number of groups fetched
+        """
+        def fetch(psk):
+            return self.groups.list_apps(psk, refresh=True), self.groups.list_members(psk, refresh=True)
+
+        pending = set(group_psks)
+        for psk, (apps, members) in imap_unordered(fetch, group_psks, self.workers):
+            for resp in [apps, members]:
+                if resp['status'] != 200:
+                    # Forget the signature of every group not done yet, so the next refresh fetches them again
+                    with self.lock, self.db:
+                        self.db.executemany('UPDATE groups SET signature = NULL WHERE psk = ?',
+                                            [(i,) for i in pending])
+                    return resp
+            with self.lock, self.db:
+                if signatures and psk in signatures:
+                    self.db.execute('UPDATE groups SET signature = ? WHERE psk = ?', (signatures[psk], psk))
+                self.db.execute('DELETE FROM group_apps WHERE group_psk = ?', (psk,))
+                self.db.execute('DELETE FROM group_users WHERE group_psk = ?', (psk,))
+                self.db.executemany('INSERT OR IGNORE INTO group_apps VALUES (?, ?)',
+                                    [(psk, str(i['psk'])) for i in apps['result']])
+                self.db.executemany('INSERT OR IGNORE INTO group_users VALUES (?, ?)',
+                                    [(psk, str(i['psk'])) for i in members['result']])
+            pending.discard(psk)
+        return {'status': 200, 'result': len(group_psks)}
+
+    def query(self, sql, params=()):
+        """
+        :param sql: SELECT statement to run on the mirror. Tables are apps, users, groups, group_apps, group_users
+        :param params: Optional. Values for the ? placeholders in sql
+        :return: List of row tuples
+        """
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def records(self, sql, params=()):
+        return [codec.loads(row[0]) for row in OrgMirror.query(self, sql, params)]
+
+    def get_app(self, psk=None, bundle_id=None, name=None):
+        """
+        :return: List of dicts of the apps with the given psk, bundle id or name, as returned by Apps.list()
+        """
+        column, value = OrgMirror.lookup(psk=psk, bundle_id=bundle_id, name=name)
+        return OrgMirror.records(self, 'SELECT data FROM apps WHERE {} = ?'.format(column), (value,))
+
+    def get_user(self, psk=None, id=None, email=None):
+        """
+        :return: List of dicts of the users with the given psk, user id or email, as returned by Users.list()
+        """
+        column, value = OrgMirror.lookup(psk=psk, id=id, email=email)
+        return OrgMirror.records(self, 'SELECT data FROM users WHERE {} = ?'.format(column), (value,))
+
+    def get_group(self, psk=None, name=None):
+        """
+        :return: List of dicts of the groups with the given psk or name, as returned by Groups.list()
+        """
+        column, value = OrgMirror.lookup(psk=psk, name=name)
+        return OrgMirror.records(self, 'SELECT data FROM groups WHERE {} = ?'.format(column), (value,))
+
+    @staticmethod
+    def lookup(**kwargs):
+        matches = [(k, v) for k, v in kwargs.items() if v is not None]
+        if len(matches) != 1:
+            raise ValueError('Pass exactly one of: {}'.format(', '.join(sorted(kwargs))))
+        column, value = matches[0]
+        return column, str(value) if column == 'psk' else value
+
+    def groups_for_app(self, app_psk):
+        """
+        :return: List of dicts of the groups that contain the app
+        """
+        return OrgMirror.records(self, 'SELECT g.data FROM groups g JOIN group_apps m ON m.group_psk = g.psk '
+                                       'WHERE m.app_psk = ?', (str(app_psk),))
+
+    def groups_for_user(self, user_psk):
+        """
+        :return: List of dicts of the groups the user is a member of
+        """
+        return OrgMirror.records(self, 'SELECT g.data FROM groups g JOIN group_users m ON m.group_psk = g.psk '
+                                       'WHERE m.user_psk = ?', (str(user_psk),))
+
+    def apps_in_group(self, group_psk):
+        """
+        :return: List of dicts of the apps in the group, with the details from Apps.list()
+        """
+        return OrgMirror.records(self, 'SELECT a.data FROM apps a JOIN group_apps m ON m.app_psk = a.psk '
+                                       'WHERE m.group_psk = ?', (str(group_psk),))
+
+    def users_in_group(self, group_psk):
+        """
+        :return: List of dicts of the group's members, with the details from Users.list()
+        """
+        return OrgMirror.records(self, 'SELECT u.data FROM users u JOIN group_users m ON m.user_psk = u.psk '
+                                       'WHERE m.group_psk = ?', (str(group_psk),))
+
+    def users_without_group(self):
+        """
+        :return: List of dicts of the users that are not in any group
+        """
+        return OrgMirror.records(self, 'SELECT data FROM users WHERE psk NOT IN (SELECT user_psk FROM group_users)')
+
+    def apps_without_group(self):
+        """
+        :return: List of dicts of the apps that are not in any group
+        """
+        return OrgMirror.records(self, 'SELECT data FROM apps WHERE psk NOT IN (SELECT app_psk FROM group_apps)')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -1,110 +1,285 @@
-import json
 import logging
-from subprocess import PIPE, Popen
+import threading
+import requests
+import transfer
+from concurrency import imap_unordered
 from helpers import response_check
+from cache import cached
 
 
 class Publish:
-    def __init__(self, php_session, php_payload, py_session, region):
+    def __init__(self, php_session, rpc, py_session, region, cache=None, state_dir=None, upload_session=None):
+        """
+        :param upload_session: Optional. requests.Session to send files to the File Uploader with. A new one is made
+            if not given
+        """
         self.token, self.transactionID, self.file_id = '', '', ''
-        self.payload = php_payload
+        self.rpc = rpc
         self.php_session = php_session
         self.py_session = py_session
+        self.upload_session = upload_session or requests.Session()
+        self.upload_state = transfer.UploadState(state_dir)
         self.region = region
+        self.cache = cache
 
-    def add_new_app(self, file_name, metadata):
+    def add_new_app(self, file_name, metadata, chunk_size=None, progress=None):
         """
         Adds a new app to your EASE instance under the category "Company Wide".
         Uses the functions create, upload, and publish
 
         :param file_name: name of the file you will be uploading. Can be a relative or absolute path
         :param metadata: Dict of the metadata needed to publish to ease. See API docs for dict keys
+        :param chunk_size: Optional. Upload the file in chunks of this many bytes. If an earlier chunked upload of
+            the same file was interrupted, its transaction is reused and the upload continues where it stopped
+        :param progress: Optional. Function called with (bytes_sent, bytes_total) as the file is sent
 
         :return:
 
         https://help.apperian.com/display/pub/apps.publish
         """
         pub_data = dict(file_name=file_name)
-        transaction_id = Publish.create(self)
-        if transaction_id['status'] == 200:
-            pub_data['transactionID'] = transaction_id['result']
-            file_id = Publish.upload(self, pub_data)
-            if file_id['status'] == 200:
-                pub_data['file_id'] = file_id['result']
-                pub = Publish.publish(self, metadata, pub_data)
-                return pub
-            else:
-                return file_id
-        else:
+        transaction_id = Publish.start_transaction(self, pub_data, chunk_size)
+        if transaction_id['status'] != 200:
             return transaction_id
 
+        file_id = Publish.upload(self, pub_data, progress, chunk_size=chunk_size)
+        if file_id['status'] == 200:
+            pub_data['file_id'] = file_id['result']
+            pub = Publish.publish(self, metadata, pub_data)
+            if pub['status'] == 200 and chunk_size:
+                self.upload_state.remove(pub_data['file_hash'])
+            return pub
+        else:
+            return file_id
+
+    def start_transaction(self, data, chunk_size=None):
+        """
+        Gets a transactionID for a new app. For a chunked upload, the transaction of an interrupted upload of the same
+        file is reused, otherwise the new one is recorded so this upload can be resumed
+
+        :param data: Dict with the key file_name. transactionID is added to it, and file_hash if chunk_size is given
+        :param chunk_size: Optional. Number of bytes per chunk the file will be uploaded in
+        :return: Dict with the status and, as result, the transactionID
+        """
+        if chunk_size:
+            if 'file_hash' not in data:
+                data['file_hash'] = transfer.file_hash(data['file_name'], 'sha1')
+            state = self.upload_state.get(data['file_hash'])
+            if state and not state.get('app_id'):
+                data['transactionID'] = state['transactionID']
+                return {'status': 200, 'result': data['transactionID']}
+
+        resp = Publish.create(self)
+        if resp['status'] != 200:
+            return resp
+        data['transactionID'] = resp['result']
+        if chunk_size:
+            self.upload_state.save(data['file_hash'], {'transactionID': data['transactionID']})
+        return resp
+
+    def resume_transaction(self, data, app_id):
+        """
+        Used for chunked uploads of a new version of an existing app. If an earlier upload of the same file to the
+        same app was interrupted, data's transactionID is replaced with the one that upload used. Otherwise data's
+        transactionID is recorded so this upload can be resumed.
+
+        :param data: Dict with the keys: file_name, transactionID. file_hash is added to it
+        :param app_id: appID of the app the file is uploaded to
+        :return: data
+        """
+        data['file_hash'] = transfer.file_hash(data['file_name'], 'sha1')
+        state = self.upload_state.get(data['file_hash'])
+        if state and state.get('app_id') == app_id:
+            data['transactionID'] = state['transactionID']
+        else:
+            self.upload_state.save(data['file_hash'], {'transactionID': data['transactionID'], 'app_id': app_id})
+        return data
+
+    def publish_many(self, items, create_workers=2, upload_workers=4, publish_workers=2, chunk_size=None):
+        """
+        Adds many new apps at once. Each file goes through create, upload and publish like add_new_app(), but the
+        stages of different files overlap, so uploads run while other files are being created or published. Each
+        stage has its own concurrency limit.
+
+        :param items: List of (file_name, metadata) tuples. See add_new_app()
+        :param create_workers: Number of create calls to run at the same time
+        :param upload_workers: Number of files to upload at the same time
+        :param publish_workers: Number of publish calls to run at the same time
+        :param chunk_size: Optional. Upload files in chunks of this many bytes, resuming interrupted uploads like
+            add_new_app(). Progress is kept per file contents, so a file identical to another one in items is sent
+            in one piece instead
+        :return: List of dicts in the same order as items. Dict keys are: file_name, stage, status, result. stage is
+            the last stage that ran, so a status of 200 at the publish stage means the app was added
+        """
+        stages = [('create', threading.BoundedSemaphore(create_workers)),
+                  ('upload', threading.BoundedSemaphore(upload_workers)),
+                  ('publish', threading.BoundedSemaphore(publish_workers))]
+        hashes = set()
+        lock = threading.Lock()
+
+        def run(item):
+            file_name, metadata = item[1]
+            data = {'file_name': file_name}
+            report = {'file_name': file_name}
+            chunked = None
+            for stage, limit in stages:
+                report['stage'] = stage
+                with limit:
+                    if stage == 'create':
+                        if chunk_size:
+                            data['file_hash'] = transfer.file_hash(file_name, 'sha1')
+                            with lock:
+                                if data['file_hash'] not in hashes:
+                                    chunked = chunk_size
+                                hashes.add(data['file_hash'])
+                        resp = Publish.start_transaction(self, data, chunked)
+                    elif stage == 'upload':
+                        resp = Publish.upload(self, data, chunk_size=chunked)
+                        data['file_id'] = resp['result']
+                    else:
+                        resp = Publish.publish(self, metadata, data)
+                        if resp['status'] == 200 and chunked:
+                            # Same as add_new_app(), the transaction is used up once the app is published
+                            self.upload_state.remove(data['file_hash'])
+                report.update(resp)
+                if resp['status'] != 200:
+                    break
+            return report
+
+        items = list(enumerate(items))
+        workers = max(1, min(len(items), create_workers + upload_workers + publish_workers))
+        results = sorted(imap_unordered(run, items, workers), key=lambda pair: pair[0][0])
+        return [report for item, report in results]
+
     def create(self):
         """
         Creates an entry in EASE for the publishing API to upload a file to.
         Uses a token from the auth function
         :return: Returns transaction ID
         """
-        self.payload['method'] = "com.apperian.eas.apps.create"
-        r = self.php_session.post(self.region['PHP Web Services'], data=json.dumps(self.payload))
-        result = response_check(r, 'result', 'transactionID')
+        result = self.rpc.call("com.apperian.eas.apps.create", None, 'result', 'transactionID')
 
         return result
 
-    def upload(self, data):
+    def upload(self, data, progress=None, retries=3, chunk_size=None):
         """
+        Streams the file to the File Uploader as a multipart form. The connection to the uploader is kept open
+        between uploads.
+
         :param data: Dict with the file anme and transaction ID. Dict keys are: file_name, transactionID
+        :param progress: Optional. Function called with (bytes_sent, bytes_total) as the file is sent
+        :param retries: Optional. Number of times to retry the upload on a connection error or 5xx response
+        :param chunk_size: Optional. Send the file in chunks of this many bytes. Progress is saved after every
+            chunk, so calling upload again with the same transactionID resumes from the last acknowledged chunk
         :return: returns fileID for the publish step
         """
+        if chunk_size:
+            return Publish.upload_chunked(self, data, chunk_size, progress, retries)
+
         result = {}
         url = '{}/upload?transactionID={}'.format(self.region['File Uploader'], data['transactionID'])
-        file_id, err = Popen(['curl', '--form', 'LUuploadFile=@{}'.format(data['file_name']), url],
-                             stdout=PIPE, stdin=PIPE, stderr=PIPE).communicate()
         try:
-            result['result'] = json.loads(file_id)['fileID']
+            r = transfer.upload_file(self.upload_session, url, data['file_name'], progress=progress, retries=retries)
+        except requests.RequestException as e:
+            logging.debug('Upload of {} to {} failed: {}'.format(data['file_name'], url, e))
+            return {'status': 500, 'result': str(e)}
+
+        try:
+            result['result'] = r.json()['fileID']
             result['status'] = 200
         except (KeyError, ValueError):
-            result['status'] = 500
-            logging.debug([file_id, 'curl --form', 'LUuploadFile=@{} {}'.format(data['file_name'], url)])
-            result['result'] = [file_id, 'curl --form', 'LUuploadFile=@{} {}'.format(data['file_name'], url)]
+            result['status'] = 500 if r.status_code == 200 else r.status_code
+            logging.debug('Upload of {} to {} failed: {}'.format(data['file_name'], url, r.text))
+            result['result'] = r.text
 
         return result
 
+    def upload_chunked(self, data, chunk_size, progress=None, retries=3):
+        """
+        See upload()
+
+        :param data: Dict with the keys: file_name, transactionID and optionally file_hash
+        :return: returns fileID for the publish step
+        """
+        file_hash = data.get('file_hash') or transfer.file_hash(data['file_name'], 'sha1')
+        state = self.upload_state.get(file_hash, data['transactionID'])
+        if state and state.get('file_id'):
+            return {'status': 200, 'result': state['file_id']}
+
+        url = '{}/upload?transactionID={}'.format(self.region['File Uploader'], data['transactionID'])
+        try:
+            r = transfer.upload_chunks(self.upload_session, url, data['file_name'], self.upload_state, file_hash,
+                                       data['transactionID'], chunk_size, progress=progress, retries=retries)
+        except requests.RequestException as e:
+            logging.debug('Chunked upload of {} to {} failed: {}'.format(data['file_name'], url, e))
+            return {'status': 500, 'result': str(e)}
+
+        try:
+            file_id = r.json()['fileID']
+        except (KeyError, ValueError):
+            logging.debug('Chunked upload of {} to {} failed: {}'.format(data['file_name'], url, r.text))
+            if 400 <= r.status_code < 500:
+                # The transaction was rejected, so there is nothing left to resume
+                self.upload_state.remove(file_hash)
+            if r.status_code < 400:
+                # upload_chunks() stopped at a chunk the uploader did not acknowledge
+                return {'status': 500, 'result': r.text or 'Chunk not acknowledged by the File Uploader'}
+            return {'status': r.status_code, 'result': r.text}
+
+        state = self.upload_state.get(file_hash) or {}
+        state['file_id'] = file_id
+        self.upload_state.save(file_hash, state)
+        return {'status': 200, 'result': file_id}
+
     def update(self, app_id):
-        self.payload['method'] = "com.apperian.eas.apps.update"
-        self.payload['params'].update({'appID': app_id})
-        r = self.php_session.post(self.region['PHP Web Services'], data=json.dumps(self.payload))
-        result = response_check(r, 'result')
+        result = self.rpc.call("com.apperian.eas.apps.update", {'appID': app_id}, 'result')
         return result
 
-    def get_list(self):
+    def update_many(self, app_ids):
+        """
+        Same as update() for many apps, sent as JSON-RPC batches so it only takes a few requests
+
+        :param app_ids: List of appIDs
+        :return: Dict of appID to the result update() would have returned
+        """
+        app_ids = list(app_ids)
+        calls = [("com.apperian.eas.apps.update", {'appID': i}, 'result') for i in app_ids]
+        return dict(zip(app_ids, self.rpc.batch(calls)))
+
+    def get_list(self, stream=False):
         """
         Lists all of the native apps in the organization you are authenticated to. Does not include webapps, or public
         app store links
 
+        :param stream: Optional. True to parse the response as it is read and only decode the list. See response_check()
         :return: List of dicts of app metadata. Dict keys are: ID, author, bundleID, longdescription, shortdescription,
             status, type, version, versionNotes
         """
-        self.payload['method'] = "com.apperian.eas.apps.getlist"
-        r = self.php_session.post(self.region['PHP Web Services'], data=json.dumps(self.payload))
-        result = response_check(r, 'result', 'applications')
+        result = self.rpc.call("com.apperian.eas.apps.getlist", None, 'result', 'applications', stream=stream)
         return result
 
+    def iter_list(self):
+        """
+        Same as get_list(), but yields each app as it is read from the response
+
+        :return: Generator of dicts of app metadata
+        :raises ResponseError: If the call fails
+        """
+        return self.rpc.iter_call("com.apperian.eas.apps.getlist", None, 'result', 'applications')
+
     def publish(self, metadata, publishing_data):
         """
         :param metadata: Dict of the metadata that is required to upload to ease
         :param publishing_data: Dict of the params needed to publish
         """
-        self.payload['method'] = 'com.apperian.eas.apps.publish'
-        self.payload['params'].update(
-            {"EASEmetadata": metadata,
-             "files": {"application": publishing_data['file_id']},
-             "transactionID": publishing_data['transactionID']
-             }
-        )
-        r = self.php_session.post(self.region['PHP Web Services'], data=json.dumps(self.payload))
-        result = response_check(r, 'result', 'appID')
+        params = {"EASEmetadata": metadata,
+                  "files": {"application": publishing_data['file_id']},
+                  "transactionID": publishing_data['transactionID']
+                  }
+        result = self.rpc.call('com.apperian.eas.apps.publish', params, 'result', 'appID')
         return result
 
+    @cached('credentials')
     def get_credentials(self):
         """
         Lists all stored signing credentials for authenticated user's account
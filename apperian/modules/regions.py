@@ -0,0 +1,91 @@
+# coding=utf-8
+import os
+import time
+import logging
+import requests
+from concurrency import imap_unordered
+from helpers import read_json, write_json
+
+# Regions Ease(region='auto') chooses from unless given others: the production regions Apperian runs, and the
+# configured default. The credentials are sent to each candidate in turn, so QA and partner-run regions are left out
+PRODUCTION_REGIONS = ['default', 'na', 'eu']
+
+# Region picked for each user by Ease(region='auto'), so later runs skip the probing
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.apperian', 'regions.json')
+
+
+def probe(url, attempts=3, timeout=5):
+    """
+    Sends HEAD requests to url over one connection. Any HTTP response counts, the status does not matter
+
+    :param url: Python Web Services URL of a region
+    :param attempts: Number of requests to send. The first one also pays for the connection and TLS handshake
+    :param timeout: Seconds to wait for each request
+    :return: Fastest round trip in seconds, or None if the host could not be reached
+    """
+    session = requests.Session()
+    times = []
+    try:
+        for i in range(attempts):
+            start = time.time()
+            try:
+                session.head(url, timeout=timeout)
+            except requests.RequestException as e:
+                logging.debug('Unable to reach %s: %s', url, e)
+                return None
+            times.append(time.time() - start)
+    finally:
+        session.close()
+    return min(times)
+
+
+def rank(regions, attempts=3, timeout=5, workers=8):
+    """
+    Probes the Python Web Services host of every region at the same time. Regions that share a host, like default
+    and na, are only probed once and the named one is kept
+
+    :param regions: Dict of region name to its URLs, as in endpoints.json
+    :param attempts: Number of requests to send to each host
+    :param timeout: Seconds to wait for each request
+    :param workers: Number of hosts to probe at once
+    :return: List of (region name, seconds) tuples of the reachable regions, fastest first
+    """
+    names = {}
+    for name in sorted(regions):
+        url = regions[name].get('Python Web Services')
+        if url and names.get(url, 'default') == 'default':
+            names[url] = name
+
+    latencies = imap_unordered(lambda url: probe(url, attempts, timeout), sorted(names), workers)
+    ranked = sorted((latency, names[url]) for url, latency in latencies if latency is not None)
+    for latency, name in ranked:
+        logging.debug('Region %s: %.1f ms', name, latency * 1000)
+    return [(name, latency) for latency, name in ranked]
+
+
+def cached_region(user, path=None, ttl=86400):
+    """
+    :param user: User ID the region was picked for
+    :param path: Optional. json file the choices are kept in. Defaults to ~/.apperian/regions.json
+    :param ttl: Seconds a choice is reused for before the regions are probed again
+    :return: Name of the region picked for user, or None if there isn't one or it expired
+    """
+    entry = read_json(path or DEFAULT_PATH, {}).get(user)
+    if not entry or entry['time'] + ttl < time.time():
+        return None
+    return entry['region']
+
+
+def save_region(user, name, path=None):
+    """
+    :param user: User ID the region was picked for
+    :param name: Region name
+    :param path: Optional. json file the choices are kept in. Defaults to ~/.apperian/regions.json
+    """
+    path = path or DEFAULT_PATH
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    choices = read_json(path, {})
+    choices[user] = {'region': name, 'time': time.time()}
+    write_json(path, choices)
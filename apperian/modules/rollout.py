@@ -0,0 +1,86 @@
+# coding=utf-8
+import logging
+import threading
+from concurrency import imap_unordered
+from helpers import read_json, write_json
+
+
+class Rollout:
+    def __init__(self, apps, wrapper, policies, cred_psk, workers=4, state_file=None, timeout=None):
+        """
+        Wraps and then signs a list of apps, keeping up to workers apps in flight at once. All outstanding jobs are
+        polled together by the connectors' JobWatcher. If state_file is given, progress is saved to it after every
+        step, and running the same rollout again skips the steps that already succeeded.
+
+        :param apps: Apps instance
+        :param wrapper: Wrapper instance
+        :param policies: List of policy numbers to apply to every app. See Wrapper.convert_policies()
+        :param cred_psk: Unique ID of the signing credentials
+        :param workers: Number of apps to have in flight at the same time
+        :param state_file: Optional. Path of a json file to save progress to
+        :param timeout: Optional. Seconds to wait for each wrap or sign job
+        """
+        self.apps = apps
+        self.wrapper = wrapper
+        self.policies = policies
+        self.cred_psk = cred_psk
+        self.workers = workers
+        self.state_file = state_file
+        self.timeout = timeout
+        self.state = read_json(state_file, {}) if state_file else {}
+        self.lock = threading.Lock()
+
+    def run(self, app_psks):
+        """
+        :param app_psks: List of psks of the apps to wrap and sign
+        :return: List of dicts in the same order as app_psks. Dict keys are: psk, stage, status, result. stage is
+            done if the app was wrapped and signed, otherwise it is the step that failed: wrap or sign
+        """
+        app_psks = list(app_psks)
+        results = dict(imap_unordered(lambda psk: Rollout.process(self, psk), app_psks, self.workers))
+        return [results[psk] for psk in app_psks]
+
+    def process(self, psk):
+        row = dict(self.state.get(str(psk)) or {'stage': 'wrap'}, psk=psk)
+        if row['stage'] == 'done':
+            return row
+
+        if row['stage'] == 'wrap':
+            resp = self.wrapper.wrap(psk, self.policies, async=True)
+            if resp['status'] in [200, 202] and not resp.get('skipped'):
+                # The status right after submitting can be left over from the last wrap, so a 200 doesn't mean the
+                # new one has finished. Wait for it before signing
+                resp = self.wrapper.watcher.watch_wrap(psk, self.timeout).wait()
+            Rollout.record(self, row, resp, 'sign')
+            if resp['status'] != 200:
+                return row
+
+        resp = self.apps.sign(psk, self.cred_psk, async=True)
+        if resp['status'] == 200:
+            resp = self.apps.watcher.watch_signing(psk, self.timeout).wait()
+        Rollout.record(self, row, resp, 'done')
+        return row
+
+    def record(self, row, resp, next_stage):
+        row.update(resp)
+        if resp['status'] == 200:
+            row['stage'] = next_stage
+        logging.debug('Rollout {} - {} {}'.format(row['psk'], row['stage'], resp['status']))
+        if self.state_file:
+            with self.lock:
+                self.state[str(row['psk'])] = dict(row)
+                write_json(self.state_file, self.state)
+
+    @staticmethod
+    def format_table(rows):
+        """
+        :param rows: List returned by run()
+        :return: String of a plain text table with one line per app
+        """
+        lines = [(str(i['psk']), i['stage'], str(i.get('status', '')), str(i.get('result', ''))) for i in rows]
+        header = ('psk', 'stage', 'status', 'result')
+        widths = [max(len(line[col]) for line in lines + [header]) for col in range(3)]
+        out = []
+        for line in [header] + lines:
+            out.append('  '.join(line[col].ljust(widths[col]) for col in range(3)) + '  ' + line[3])
+        return '\n'.join(out)
@@ -0,0 +1,195 @@
+# coding=utf-8
+import re
+import json
+import codecs
+import logging
+from helpers import ResponseError, response_check
+
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = ' \t\n\r'
+# Everything up to the next bracket that is not inside a string. Used to skip over values without decoding them
+SKIP = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+# Characters a number can continue with. A number followed only by these may be cut short by the end of the buffer
+NUMBER_TAIL = re.compile(r'[0-9.eE+-]*\Z')
+
+
+class JSONStream:
+    def __init__(self, chunks):
+        """
+        Reads a json document from an iterable of byte chunks, holding only as much of it in memory as the value
+        currently being decoded. Used to walk down to a list inside a large response and decode its items one by one.
+        Decodes with the standard library, as the libraries in codec cannot decode a value at an offset of a buffer.
+
+        :param chunks: Iterable of byte strings. For example: response.iter_content(CHUNK_SIZE)
+        """
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json = json.JSONDecoder()
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+
+    def more(self):
+        """
+        :return: False if there is nothing left to read
+        """
+        if self.eof:
+            return False
+        # Drop what has already been parsed so the buffer does not grow with the document
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            self.buf += self.decoder.decode(b'', True)
+            return False
+        self.buf += self.decoder.decode(chunk)
+        return True
+
+    def peek(self):
+        """
+        :return: Next character that is not whitespace, without consuming it. Empty string at the end of the document
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not JSONStream.more(self):
+                return u''
+
+    def expect(self, chars):
+        char = JSONStream.peek(self)
+        if not char or char not in chars:
+            raise ValueError('Expected one of {} at {!r}'.format(chars, self.buf[self.pos:self.pos + 40]))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        :return: Next value, decoded
+        """
+        JSONStream.peek(self)
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not JSONStream.read_ahead(self):
+                    raise
+                continue
+            # A number can decode fine but be cut short by the end of the buffer, for example 1.5 split after 1.
+            if self.buf[self.pos] in u'-0123456789' and not self.eof and NUMBER_TAIL.match(self.buf, end):
+                JSONStream.more(self)
+                continue
+            self.pos = end
+            return value
+
+    def read_ahead(self):
+        """
+        Reads until the unparsed part of the buffer has doubled, so a large value is decoded in a few attempts
+        instead of once per chunk
+
+        :return: False if there was nothing left to read
+        """
+        before = len(self.buf) - self.pos
+        while JSONStream.more(self) and len(self.buf) - self.pos < 2 * before:
+            pass
+        return len(self.buf) - self.pos > before
+
+    def skip(self):
+        """
+        Moves past the next value without decoding it
+        """
+        char = JSONStream.peek(self)
+        if not char or char not in u'[{':
+            JSONStream.value(self)
+            return
+        depth = 0
+        while True:
+            self.pos = SKIP.match(self.buf, self.pos).end()
+            if self.pos == len(self.buf) or self.buf[self.pos] == u'"':
+                # End of the buffer, or a string that is cut off by it
+                if not JSONStream.read_ahead(self):
+                    raise ValueError('Unexpected end of json')
+                continue
+            depth += 1 if self.buf[self.pos] in u'[{' else -1
+            self.pos += 1
+            if depth == 0:
+                return
+
+    def find(self, *path):
+        """
+        Moves to the value at path, skipping everything before it.
+
+        :param path: Keys to walk down
+        :raises ResponseError: If the document has an error key, or a key in path is missing
+        """
+        for depth, key in enumerate(path):
+            JSONStream.expect(self, u'{')
+            while True:
+                if JSONStream.peek(self) == u'}':
+                    raise ResponseError(500, 'Expected key {} not present in response'.format(key))
+                name = JSONStream.value(self)
+                JSONStream.expect(self, u':')
+                if name == key:
+                    break
+                if name == 'error' and depth == 0:
+                    raise ResponseError(401, JSONStream.value(self))
+                JSONStream.skip(self)
+                if JSONStream.expect(self, u',}') == u'}':
+                    raise ResponseError(500, 'Expected key {} not present in response'.format(key))
+
+    def items(self):
+        """
+        :return: Generator of the decoded items of the list at the current position
+        """
+        JSONStream.expect(self, u'[')
+        if JSONStream.peek(self) == u']':
+            self.pos += 1
+            return
+        while True:
+            yield JSONStream.value(self)
+            if JSONStream.expect(self, u',]') == u']':
+                return
+
+
+def iter_response(r, *path):
+    """
+    :param r: requests.Response, ideally made with stream=True
+    :param path: Keys to walk down to the list, same as the args of response_check()
+    :return: Generator of the items of the list
+    :raises ResponseError: If the request failed or the response does not have the list
+    """
+    if r.status_code != 200:
+        resp = response_check(r, *path)
+        raise ResponseError(resp['status'], resp['result'])
+    stream = JSONStream(r.iter_content(CHUNK_SIZE))
+    try:
+        JSONStream.find(stream, *path)
+        for item in JSONStream.items(stream):
+            yield item
+    except ValueError as e:
+        raise ResponseError(500, 'Unable to parse json from response: {}'.format(e))
+    finally:
+        r.close()
+
+
+def iter_pages(session, url, *path):
+    """
+    GETs url with a streamed response and yields the items of the list at path. If the response has a Link header
+    with rel="next", that page is fetched after the last item of this one, and so on.
+
+    :param session: requests.Session
+    :param url: URL of the first page
+    :param path: Keys to walk down to the list
+    :return: Generator of the items of every page
+    """
+    while url:
+        r = session.get(url, stream=True)
+        next_url = r.links.get('next', {}).get('url')
+        for item in iter_response(r, *path):
+            yield item
+        logging.debug('Finished page {}'.format(url))
+        url = next_url
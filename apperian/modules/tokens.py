@@ -0,0 +1,96 @@
+# coding=utf-8
+import os
+import time
+import logging
+import threading
+import requests
+from helpers import write_json, read_json
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.apperian', 'tokens.json')
+
+
+class TokenCache:
+    def __init__(self, path=DEFAULT_PATH, ttl=3600):
+        """
+        Keeps the result of /users/authenticate/ on disk, by user and region, so new Ease instances can reuse a token
+        instead of authenticating again. Passwords are never written. A token the server has already expired is
+        replaced the first time a request gets a 401.
+
+        :param path: Optional. json file to keep the tokens in. Defaults to ~/.apperian/tokens.json
+        :param ttl: Seconds a token is reused for after it was issued
+        """
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(user, region):
+        """
+        :param user: User ID the token was issued to
+        :param region: Region dict, as in endpoints.json
+        :return: Key of the token in the file. The Python Web Services URL identifies the region
+        """
+        return '{} {}'.format(user, region['Python Web Services'])
+
+    def get(self, user, region):
+        """
+        :return: The stored /users/authenticate/ result for user in region, or None if there isn't one or it expired
+        """
+        with self.lock:
+            entry = read_json(self.path, {}).get(TokenCache.key(user, region))
+        if not entry or entry['expires'] < time.time():
+            return None
+        logging.debug('Using cached token for %s', user)
+        return entry['user_data']
+
+    def set(self, user, region, user_data):
+        """
+        :param user_data: Result of /users/authenticate/
+        """
+        TokenCache.update(self, TokenCache.key(user, region), {'expires': time.time() + self.ttl,
+                                                               'user_data': user_data})
+
+    def remove(self, user, region):
+        TokenCache.update(self, TokenCache.key(user, region), None)
+
+    def update(self, key, entry):
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            now = time.time()
+            tokens = dict((k, v) for k, v in read_json(self.path, {}).items() if v['expires'] > now)
+            if entry:
+                tokens[key] = entry
+            else:
+                tokens.pop(key, None)
+            write_json(self.path, tokens, 0o600)
+
+
+class AuthSession(requests.Session):
+    def __init__(self, authenticate=None):
+        """
+        requests.Session that makes sure there is a token before each request and, if the server answers 401,
+        authenticates again and sends the request one more time
+
+        :param authenticate: Function taking the token a request was sent with, or None before the first request.
+            It authenticates if that token is missing or stale and returns True if a usable token is now set
+        """
+        requests.Session.__init__(self)
+        self.authenticate = authenticate
+
+    def request(self, method, url, *args, **kwargs):
+        """
+        :param retry_auth: Optional. False to send the request as is, without authenticating or retrying
+        """
+        if not kwargs.pop('retry_auth', True) or not self.authenticate:
+            return requests.Session.request(self, method, url, *args, **kwargs)
+
+        self.authenticate(None)
+        token = self.headers.get('X-TOKEN')
+        r = requests.Session.request(self, method, url, *args, **kwargs)
+        if r.status_code == 401 and self.authenticate(token):
+            logging.debug('Got 401, retrying with a new token: %s %s', method, url)
+            r.close()
+            r = requests.Session.request(self, method, url, *args, **kwargs)
+        return r
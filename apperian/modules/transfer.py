@@ -0,0 +1,466 @@
+# coding=utf-8
+import os
+import re
+import sys
+import uuid
+import hashlib
+import time
+import logging
+import threading
+import requests
+from helpers import read_json, write_json
+
+CHUNK_SIZE = 1024 * 1024
+# Files smaller than segments * MIN_SEGMENT_SIZE are fetched in a single stream
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+
+
+class Progress:
+    def __init__(self, callback, total, done=0):
+        """
+        Thread safe byte counter that reports to callback(bytes_done, bytes_total) every time it changes.
+        bytes_total is None when the server does not send a size.
+        """
+        self.callback = callback
+        self.total = total
+        self.done = done
+        self.lock = threading.Lock()
+        self.report()
+
+    def add(self, count):
+        with self.lock:
+            self.done += count
+            self.report()
+
+    def reset(self, count):
+        with self.lock:
+            self.done -= count
+            self.report()
+
+    def report(self):
+        if self.callback:
+            self.callback(self.done, self.total)
+
+
+class Throttle:
+    def __init__(self, bytes_per_sec):
+        """
+        Token bucket shared by any number of download threads to keep their combined rate under bytes_per_sec
+        """
+        self.rate = float(bytes_per_sec)
+        self.allowance = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate) - count
+            self.last = now
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def print_progress(done, total):
+    """
+    Default progress callback. Prints a # for every 5% of the file
+    """
+    if not total:
+        return
+    bar = int(float(done) / total * 20)
+    sys.stdout.write('\r[{:<20}] {:3}%'.format('#' * bar, bar * 5))
+    if done >= total:
+        sys.stdout.write('\n')
+    sys.stdout.flush()
+
+
+def probe(session, url):
+    """
+    Follows redirects to the real file location and checks whether it can be fetched in ranges
+
+    :return: Tuple of (status_code, final_url, total_size, supports_ranges)
+    """
+    r = session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, allow_redirects=True)
+    r.close()
+    total, ranges = None, False
+    if r.status_code == 206:
+        ranges = True
+        try:
+            total = int(r.headers['content-range'].rsplit('/', 1)[1])
+        except (KeyError, ValueError):
+            total = None
+        return 200, r.url, total, ranges and total is not None
+    if r.headers.get('content-length'):
+        total = int(r.headers['content-length'])
+    return r.status_code, r.url, total, False
+
+
+def fetch_range(session, url, path, start, end, chunk_size, progress, throttle=None):
+    """
+    Downloads bytes start-end (inclusive) of url into path. Bytes already in path are assumed to be the beginning
+    of the range and are not fetched again. Pass end=None to read to the end of the file.
+    If throttle is passed, every chunk is counted against it.
+
+    :return: HTTP status code of the request
+    """
+    have = os.path.getsize(path) if os.path.exists(path) else 0
+    offset = start + have
+    if end is not None and offset > end:
+        return 206
+
+    headers = {}
+    if offset or end is not None:
+        headers['Range'] = 'bytes={}-{}'.format(offset, '' if end is None else end)
+    r = session.get(url, headers=headers, stream=True)
+    if r.status_code not in [200, 206]:
+        r.close()
+        return r.status_code
+
+    mode = 'ab'
+    if r.status_code == 200 and offset:
+        # Server ignored the range and is sending the whole file, start over
+        logging.debug('Range not honoured for {}, restarting'.format(path))
+        progress.reset(have)
+        mode = 'wb'
+
+    with open(path, mode) as f:
+        for chunk in r.iter_content(chunk_size):
+            f.write(chunk)
+            progress.add(len(chunk))
+            if throttle:
+                throttle.consume(len(chunk))
+    return r.status_code
+
+
+def file_hash(path, algorithm, chunk_size=CHUNK_SIZE):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_file(session, url, file_name, chunk_size=CHUNK_SIZE, segments=4, progress=None, checksum=None,
+                  throttle=None):
+    """
+    Downloads url to file_name. Data is written to file_name + '.part' first so an interrupted download resumes
+    where it stopped the next time it is called. If the server supports Range requests and the file is large
+    enough, it is fetched as several segments in parallel.
+
+    :param session: requests.Session to download with
+    :param url: Location of the file. Redirects are followed
+    :param file_name: Path to save the file to
+    :param chunk_size: Number of bytes read from the network per write
+    :param segments: Maximum number of parallel range requests
+    :param progress: Optional. Function called with (bytes_done, bytes_total) as the download progresses
+    :param checksum: Optional. Tuple of (hashlib algorithm name, hex digest) the finished file must match
+    :param throttle: Optional. Throttle instance to limit the download rate, can be shared between downloads
+    :return: Dict with the status and the file name on success
+    """
+    status, url, total, ranges = probe(session, url)
+    if status != 200:
+        return {'status': status, 'result': 'Failed'}
+
+    part = '{}.part'.format(file_name)
+    if ranges and segments > 1 and total >= segments * MIN_SEGMENT_SIZE and not os.path.exists(part):
+        status = fetch_segments(session, url, part, total, segments, chunk_size, progress, throttle)
+    else:
+        if os.path.exists(part) and not ranges:
+            os.remove(part)
+        have = os.path.getsize(part) if os.path.exists(part) else 0
+        tracker = Progress(progress, total, have)
+        status = fetch_range(session, url, part, 0, total - 1 if ranges else None, chunk_size, tracker, throttle)
+    if status not in [200, 206]:
+        return {'status': status, 'result': 'Failed'}
+
+    size = os.path.getsize(part)
+    if total is not None and size != total:
+        logging.debug('Expected {} bytes for {}, got {}'.format(total, file_name, size))
+        if size > total:
+            os.remove(part)
+        return {'status': 500, 'result': 'Size mismatch, expected {} bytes got {}'.format(total, size)}
+
+    if checksum:
+        algorithm, expected = checksum
+        actual = file_hash(part, algorithm, chunk_size)
+        if actual != expected.lower():
+            os.remove(part)
+            return {'status': 500, 'result': '{} mismatch, expected {} got {}'.format(algorithm, expected, actual)}
+
+    if os.path.exists(file_name):
+        os.remove(file_name)
+    os.rename(part, file_name)
+    return {'status': 200, 'result': file_name}
+
+
+def fetch_segments(session, url, part, total, segments, chunk_size, progress, throttle=None):
+    """
+    Fetches total bytes of url as parallel range requests, each into its own part file, then joins them into part.
+    Segment files are named after their byte range, so the ones left by an interrupted run are only resumed if
+    they cover the same range. Leftovers from a run with a different number of segments are deleted. If a segment
+    is answered with the whole file instead of its range, the segments are dropped and part is fetched in a single
+    stream.
+
+    :return: HTTP status code, 200 or 206 on success
+    """
+    size = -(-total // segments)
+    bounds = [(i * size, min(total, (i + 1) * size) - 1) for i in range(segments)]
+    paths = ['{}.{}-{}'.format(part, start, end) for start, end in bounds]
+    directory = os.path.dirname(part) or '.'
+    for name in os.listdir(directory):
+        path = os.path.join(os.path.dirname(part), name)
+        if re.match(re.escape(os.path.basename(part)) + r'\.\d+-\d+$', name) and path not in paths:
+            logging.debug('Removing segment {} of another layout'.format(path))
+            os.remove(path)
+    have = sum(os.path.getsize(i) for i in paths if os.path.exists(i))
+    tracker = Progress(progress, total, have)
+    statuses = [None] * segments
+
+    def run(index):
+        try:
+            statuses[index] = fetch_range(session, url, paths[index], bounds[index][0], bounds[index][1],
+                                          chunk_size, tracker, throttle)
+        except Exception as e:
+            logging.debug('Segment {} failed: {}'.format(index, e))
+            statuses[index] = 500
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(segments)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    if 200 in statuses:
+        logging.debug('Range not honoured for {}, fetching it in a single stream'.format(part))
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        tracker.reset(tracker.done)
+        return fetch_range(session, url, part, 0, None, chunk_size, tracker, throttle)
+    failed = [i for i in statuses if i != 206]
+    if failed:
+        return failed[0]
+
+    with open(part, 'wb') as out:
+        for path in paths:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    out.write(chunk)
+    for path in paths:
+        os.remove(path)
+    return 206
+
+
+class MultipartFile:
+    def __init__(self, path, field, progress=None, offset=0, length=None):
+        """
+        File-like multipart/form-data body for a single file. The file is read from disk as the request is sent
+        instead of being loaded into memory, and the total length is known up front so no chunked encoding is needed.
+
+        :param path: Path of the file to send
+        :param field: Form field name for the file
+        :param progress: Optional. Progress instance that is told about every block of the file that is read
+        :param offset: Optional. Position in the file to start sending from
+        :param length: Optional. Number of bytes of the file to send. Defaults to everything after offset
+        """
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+        head = ('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n').format(self.boundary, field, os.path.basename(path))
+        tail = '\r\n--{}--\r\n'.format(self.boundary)
+        self.file = open(path, 'rb')
+        self.file.seek(offset)
+        self.size = os.path.getsize(path) - offset
+        if length is not None:
+            self.size = min(self.size, length)
+        self.remaining = self.size
+        self.parts = [(head.encode('utf-8'), None), (None, self.file), (tail.encode('utf-8'), None)]
+        self.len = len(self.parts[0][0]) + self.size + len(self.parts[2][0])
+        self.progress = progress
+        self.index, self.offset = 0, 0
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+        data = b''
+        while len(data) < size and self.index < len(self.parts):
+            raw, f = self.parts[self.index]
+            if f is not None:
+                block = f.read(min(size - len(data), self.remaining))
+                self.remaining -= len(block)
+                if self.progress and block:
+                    self.progress.add(len(block))
+            else:
+                block = raw[self.offset:self.offset + size - len(data)]
+                self.offset += len(block)
+            if not block:
+                self.index, self.offset = self.index + 1, 0
+            data += block
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def upload_file(session, url, path, field='LUuploadFile', progress=None, retries=3, backoff=2, timeout=None):
+    """
+    Streams path to url as a multipart form post. Connection errors and 5xx responses are retried with an
+    exponential backoff, re-sending the file from the beginning.
+
+    :param session: requests.Session to upload with
+    :param url: Upload url
+    :param path: Path of the file to upload
+    :param field: Form field name for the file
+    :param progress: Optional. Function called with (bytes_sent, bytes_total) as the file is sent
+    :param retries: Number of times to retry a failed upload
+    :param backoff: Seconds to wait before the first retry, doubled for every retry after that
+    :param timeout: Optional. Timeout passed to requests
+    :return: requests.Response of the last attempt
+    """
+    attempt = 0
+    while True:
+        tracker = Progress(progress, os.path.getsize(path))
+        body = MultipartFile(path, field, tracker)
+        try:
+            r = session.post(url, data=body, headers={'Content-Type': body.content_type}, timeout=timeout)
+            if r.status_code < 500 or attempt >= retries:
+                return r
+            logging.debug('Upload of {} got {}, retrying'.format(path, r.status_code))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries:
+                raise
+            logging.debug('Upload of {} failed: {}, retrying'.format(path, e))
+        finally:
+            body.close()
+        time.sleep(backoff * 2 ** attempt)
+        attempt += 1
+
+
+def acknowledged(r):
+    """
+    :param r: requests.Response to a chunk sent by upload_chunks()
+    :return: Number of bytes of the file the server has received, from its Range: bytes=0-N header, or None if it
+        does not say
+    """
+    match = re.match(r'bytes=0-(\d+)$', r.headers.get('Range', '').strip())
+    return int(match.group(1)) + 1 if match else None
+
+
+class UploadState:
+    def __init__(self, state_dir=None):
+        """
+        Records the progress of chunked uploads on disk so they can be resumed by a later process. There is one
+        JSON file per binary, named after the file's sha1. It holds the transactionID the upload belongs to, the
+        offset of the last acknowledged chunk and, once the upload finishes, the fileID.
+
+        :param state_dir: Optional. Directory for the state files. Defaults to ~/.apperian/uploads
+        """
+        self.state_dir = state_dir or os.path.join(os.path.expanduser('~'), '.apperian', 'uploads')
+        self.lock = threading.Lock()
+
+    def path(self, file_hash):
+        return os.path.join(self.state_dir, '{}.json'.format(file_hash))
+
+    def get(self, file_hash, transaction_id=None):
+        """
+        :param file_hash: sha1 of the binary
+        :param transaction_id: Optional. Only return the state if it belongs to this transaction
+        :return: Dict of the saved state, or None
+        """
+        state = read_json(self.path(file_hash))
+        if state is None:
+            return None
+        if transaction_id and state.get('transactionID') != transaction_id:
+            return None
+        return state
+
+    def save(self, file_hash, state):
+        with self.lock:
+            if not os.path.isdir(self.state_dir):
+                os.makedirs(self.state_dir)
+            write_json(self.path(file_hash), state)
+
+    def remove(self, file_hash):
+        with self.lock:
+            if os.path.exists(self.path(file_hash)):
+                os.remove(self.path(file_hash))
+
+
+def upload_chunks(session, url, path, state, file_hash, transaction_id, chunk_size=8 * CHUNK_SIZE, field='LUuploadFile',
+                  progress=None, retries=3, backoff=2, timeout=None):
+    """
+    Uploads path to url one chunk at a time. Every chunk is a multipart post with a Content-Range header, and the
+    offset is saved to state after the server acknowledges each chunk but the last. If state already has an offset
+    for this transaction, the upload continues from there. A failed chunk is retried on its own with an exponential
+    backoff. Every chunk but the last must be acknowledged with a Range: bytes=0-N header, otherwise the server did
+    not honour Content-Range and the upload stops, instead of publishing a binary made of the last chunk only. An
+    empty file is sent with upload_file().
+
+    :param session: requests.Session to upload with
+    :param url: Upload url
+    :param path: Path of the file to upload
+    :param state: UploadState instance
+    :param file_hash: sha1 of the file, see file_hash()
+    :param transaction_id: transactionID the upload belongs to
+    :param chunk_size: Number of bytes per chunk
+    :param field: Form field name for the file
+    :param progress: Optional. Function called with (bytes_sent, bytes_total) as the file is sent
+    :param retries: Number of times to retry each chunk
+    :param backoff: Seconds to wait before the first retry, doubled for every retry after that
+    :param timeout: Optional. Timeout passed to requests
+    :return: requests.Response for the last chunk sent. It has no fileID if a chunk was not acknowledged
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return upload_file(session, url, path, field, progress, retries, backoff, timeout)
+    saved = state.get(file_hash, transaction_id) or {}
+    # Only the offsets of acknowledged chunks before the last one are saved, but always send at least the last byte
+    # again so the response has the fileID
+    offset = min(saved.get('offset', 0), size - 1)
+    tracker = Progress(progress, size, offset)
+    r = None
+    while offset < size or r is None:
+        end = min(offset + chunk_size, size) - 1
+        attempt = 0
+        while True:
+            sent = tracker.done
+            body = MultipartFile(path, field, tracker, offset, chunk_size)
+            headers = {'Content-Type': body.content_type,
+                       'Content-Range': 'bytes {}-{}/{}'.format(offset, end, size)}
+            try:
+                r = session.post(url, data=body, headers=headers, timeout=timeout)
+                if r.status_code < 500 or attempt >= retries:
+                    break
+                logging.debug('Chunk {}-{} of {} got {}, retrying'.format(offset, end, path, r.status_code))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= retries:
+                    raise
+                logging.debug('Chunk {}-{} of {} failed: {}, retrying'.format(offset, end, path, e))
+            finally:
+                body.close()
+            tracker.reset(tracker.done - sent)
+            time.sleep(backoff * 2 ** attempt)
+            attempt += 1
+
+        if r.status_code >= 400:
+            return r
+        received = acknowledged(r)
+        if end + 1 < size:
+            if received is None or not offset < received <= end + 1:
+                logging.debug('Chunk {}-{} of {} not acknowledged, server has {} bytes'.format(offset, end, path,
+                                                                                            received))
+                return r
+            # The server may have kept less than was sent, continue from what it has
+            tracker.reset(end + 1 - received)
+            offset = received
+            saved.update({'transactionID': transaction_id, 'offset': offset, 'size': size})
+            state.save(file_hash, saved)
+        else:
+            # The caller saves the fileID. Saving the end offset first would leave nothing to send on a resume
+            offset = end + 1
+    return r
@@ -0,0 +1,84 @@
+# coding=utf-8
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# Methods that are safe to send again after a failure. POST is left out since the JSON-RPC calls, uploads and
+# creates are not idempotent, and PUT since Apps.sign() uses it to start a signing job
+IDEMPOTENT_METHODS = frozenset(['HEAD', 'GET', 'DELETE', 'OPTIONS', 'TRACE'])
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, timeout=None, *args, **kwargs):
+        """
+        HTTPAdapter that applies a default timeout to every request that does not set its own
+
+        :param timeout: Seconds, or a tuple of (connect, read) seconds
+        """
+        self.timeout = timeout
+        HTTPAdapter.__init__(self, *args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return HTTPAdapter.send(self, request, **kwargs)
+
+
+class Transport:
+    def __init__(self, pool_connections=10, pool_maxsize=10, keep_alive=True, connect_timeout=10, read_timeout=120,
+                 retries=3, backoff_factor=0.5, retry_statuses=(500, 502, 503, 504)):
+        """
+        Connection settings for the sessions of an Ease instance. Every session made by the same Transport shares
+        one adapter, so all connectors, and uploads and downloads, reuse the same pooled connections to each host.
+
+        :param pool_connections: Number of hosts to keep a connection pool for. Ease talks to up to 4: the Python
+            and PHP Web Services, the File Uploader and the File Downloader
+        :param pool_maxsize: Number of connections to keep open to each host. Raise it to match the number of
+            threads making requests at once
+        :param keep_alive: If False, connections are closed after every request
+        :param connect_timeout: Seconds to wait for a connection. None waits forever
+        :param read_timeout: Seconds to wait for the server between bytes of a response. None waits forever
+        :param retries: Number of times to retry idempotent requests that failed to connect or got a status in
+            retry_statuses. 0 to turn retries off
+        :param backoff_factor: Retries wait backoff_factor * 2 ** (retry number - 1) seconds
+        :param retry_statuses: HTTP statuses to retry on
+        """
+        self.keep_alive = keep_alive
+        self.adapter = TimeoutHTTPAdapter((connect_timeout, read_timeout), pool_connections=pool_connections,
+                                          pool_maxsize=pool_maxsize,
+                                          max_retries=Transport.retry(retries, backoff_factor, retry_statuses))
+
+    @staticmethod
+    def retry(retries, backoff_factor, retry_statuses):
+        """
+        :return: urllib3 Retry that only retries IDEMPOTENT_METHODS and hands the last response back instead of
+            raising, so it still goes through response_check()
+        """
+        kwargs = {'total': retries, 'connect': retries, 'read': retries, 'status': retries,
+                  'backoff_factor': backoff_factor, 'status_forcelist': retry_statuses, 'raise_on_status': False}
+        try:
+            return Retry(allowed_methods=IDEMPOTENT_METHODS, **kwargs)
+        except TypeError:
+            # urllib3 before 1.26 calls it method_whitelist
+            return Retry(method_whitelist=IDEMPOTENT_METHODS, **kwargs)
+
+    def mount(self, session):
+        """
+        :param session: requests.Session to send through this transport's connection pools
+        :return: session
+        """
+        session.mount('https://', self.adapter)
+        session.mount('http://', self.adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def session(self, headers=None):
+        """
+        :param headers: Optional. Dict of headers to send with every request of the session
+        :return: New requests.Session that shares this transport's connection pools
+        """
+        session = Transport.mount(self, requests.Session())
+        if headers:
+            session.headers.update(headers)
+        return session
@@ -1,12 +1,15 @@
 # coding=utf-8
-import json
+import codec
 from helpers import response_check
+from streaming import iter_pages
+from cache import cached, invalidate
 
 
 class Users:
-    def __init__(self, session, region):
+    def __init__(self, session, region, cache=None):
         self.session = session
         self.region = region
+        self.cache = cache
 
     def add(self, data):
         """
@@ -16,8 +19,9 @@ class Users:
         :return: A successful response provides a unique key (user_psk) for the user.
         """
         url = '%s/v1/users' % self.region['Python Web Services']
-        r = self.session.post(url, data=json.dumps(data))
+        r = self.session.post(url, data=codec.dumps(data))
         result = response_check(r, 'user_psk')
+        invalidate(self.cache, 'users.list')
         return result
 
     def info(self, psk):
@@ -33,18 +37,31 @@ class Users:
         result = response_check(r, 'user')
         return result
 
-    def list(self):
+    @cached('users.list')
+    def list(self, stream=False):
         """
         Lists user details for every user in the org you are authenticated to. must be admin user to run
 
+        :param stream: Optional. True to parse the response as it is read and only decode the list. See response_check()
         :return: Returns a list of dicts. Dict keys are: psk, first_name, last_name, modified_date, deleted, email,
         mobile_phone, role, created_date, until_date, disabled_reason, id, last_login_from_catalog
         """
         url = '%s/users' % self.region['Python Web Services']
-        r = self.session.get(url)
-        result = response_check(r, 'users')
+        r = self.session.get(url, stream=stream)
+        result = response_check(r, 'users', stream=stream)
         return result
 
+    def iter_list(self):
+        """
+        Same as list(), but yields each user as it is read from the response, so orgs with many users can be
+        processed in constant memory. Not cached
+
+        :return: Generator of dicts. See list() for the dict keys
+        :raises ResponseError: If the request fails
+        """
+        url = '%s/users' % self.region['Python Web Services']
+        return iter_pages(self.session, url, 'users')
+
     def delete(self, psk):
         """
         Deletes a user from your EASE organization. A deleted user can no longer access the App Catalog or the EASE
@@ -56,6 +73,9 @@ class Users:
         url = '%s/users/%s' % (self.region['Python Web Services'], psk)
         r = self.session.delete(url)
         result = response_check(r, 'delete_user_response')
+        invalidate(self.cache, 'users.list')
+        invalidate(self.cache, 'groups.list')
+        invalidate(self.cache, 'groups.members')
         return result
 
     def update(self, psk, payload):
@@ -70,6 +90,8 @@ class Users:
         :return: Dict with status and result of True/False
         """
         url = '%s/v1/users/%s' % (self.region['Python Web Services'], psk)
-        r = self.session.put(url, data=json.dumps(payload), headers={"Content-Type": "application/json"})
+        r = self.session.put(url, data=codec.dumps(payload), headers={"Content-Type": "application/json"})
         result = response_check(r, 'update_user_success')
+        invalidate(self.cache, 'users.list')
+        invalidate(self.cache, 'groups.members')
         return result
@@ -0,0 +1,217 @@
+# coding=utf-8
+import time
+import random
+import logging
+import threading
+
+WRAP_MESSAGES = {
+    -1: "Error applying policies",
+    0: "Wrapping completed, no policies applied",
+    1: "Policies applied",
+    2: "Wrapping in progress...",
+    3: "Wrapping completed, pending signing",
+    4: "Wrapping completed, no policies applied"}
+
+
+class Job:
+    def __init__(self, kind, psk, deadline):
+        """
+        Handle for a signing or wrapping job that a JobWatcher is tracking. Use wait() to block until it finishes
+        or add_done_callback() to be told when it does.
+        """
+        self.kind = kind
+        self.psk = psk
+        self.deadline = deadline
+        self.last_status = None
+        self.polls = 0
+        self.result = None
+        self.event = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        :param timeout: Optional. Seconds to wait. The job's own timeout still applies
+        :return: Dict with the status and result of the job, or None if timeout ran out first
+        """
+        self.event.wait(timeout)
+        return self.result
+
+    def add_done_callback(self, func):
+        """
+        :param func: Called with the job once it finishes. Called right away if it already has
+        """
+        with self.lock:
+            if not self.done():
+                self.callbacks.append(func)
+                return
+        func(self)
+
+    def finish(self, result):
+        with self.lock:
+            self.result = result
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception as e:
+                logging.debug('Callback for {} job {} failed: {}'.format(self.kind, self.psk, e))
+
+
+class JobWatcher:
+    def __init__(self, apps=None, wrapper=None, timeout=1800, min_interval=1, max_interval=30, backoff=1.5,
+                 jitter=0.2, workers=8):
+        """
+        Tracks any number of signing and wrapping jobs from a single background thread. Every round checks all
+        outstanding jobs together: wrap statuses in one JSON-RPC batch, and signing statuses concurrently. The
+        delay between rounds starts at min_interval, grows by backoff each round where nothing changed, up to
+        max_interval, and is randomised by +/- jitter.
+
+        :param apps: Apps instance, needed to watch signing jobs
+        :param wrapper: Wrapper instance, needed to watch wrapping jobs
+        :param timeout: Default number of seconds before a job is given up on
+        :param min_interval: Seconds between the first status checks
+        :param max_interval: Longest time between status checks
+        :param backoff: Factor the interval grows by when no job changed
+        :param jitter: Fraction of the interval to randomise by
+        :param workers: Number of signing status requests to send at once
+        """
+        self.apps = apps
+        self.wrapper = wrapper
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.workers = workers
+        self.jobs = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def watch_signing(self, app_psk, timeout=None):
+        """
+        :param app_psk: Unique ID of an app that has been sent for signing
+        :param timeout: Optional. Seconds before giving up, defaults to the watcher's timeout
+        :return: Job. Its result has the same format as Apps.sign()
+        """
+        return JobWatcher.add(self, 'sign', app_psk, timeout)
+
+    def watch_wrap(self, app_psk, timeout=None):
+        """
+        :param app_psk: Unique ID of an app that has been sent for wrapping
+        :param timeout: Optional. Seconds before giving up, defaults to the watcher's timeout
+        :return: Job. Its result has the same format as Wrapper.wrap()
+        """
+        return JobWatcher.add(self, 'wrap', app_psk, timeout)
+
+    @staticmethod
+    def wait_all(jobs, timeout=None):
+        """
+        :param jobs: List of Jobs
+        :param timeout: Optional. Total seconds to wait for all of them
+        :return: List of job results in the same order. Jobs that did not finish in time are None
+        """
+        end = time.time() + timeout if timeout is not None else None
+        for job in jobs:
+            job.wait(None if end is None else max(0, end - time.time()))
+        return [job.result for job in jobs]
+
+    def add(self, kind, psk, timeout):
+        job = Job(kind, psk, time.time() + (timeout or self.timeout))
+        with self.lock:
+            self.jobs.append(job)
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target=JobWatcher.run, args=(self,))
+                self.thread.daemon = True
+                self.thread.start()
+            else:
+                self.wakeup.set()
+        return job
+
+    def run(self):
+        interval = self.min_interval
+        while True:
+            with self.lock:
+                self.jobs = [i for i in self.jobs if not i.done()]
+                if not self.jobs:
+                    self.thread = None
+                    return
+                jobs = list(self.jobs)
+            self.wakeup.clear()
+            self.wakeup.wait(interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+            try:
+                changed = JobWatcher.poll(self, jobs)
+            except Exception as e:
+                logging.debug('Status check failed: {}'.format(e))
+                changed = False
+            interval = self.min_interval if changed else min(self.max_interval, interval * self.backoff)
+
+    def poll(self, jobs):
+        """
+        Checks the status of every job once and finishes the ones that are done
+
+        :return: True if any job changed status
+        """
+        changed = False
+        now = time.time()
+        for job in jobs:
+            if job.deadline < now:
+                job.finish({'status': 408, 'result': 'Timed out waiting for {} of {}'.format(job.kind, job.psk)})
+                changed = True
+
+        signing = [i for i in jobs if i.kind == 'sign' and not i.done()]
+        if signing:
+            details = self.apps.get_details_many([i.psk for i in signing], self.workers, refresh=True)
+            for job in signing:
+                resp = details.get(job.psk)
+                if not resp or resp['status'] != 200:
+                    continue
+                changed = JobWatcher.update_signing(job, resp) or changed
+
+        wrapping = [i for i in jobs if i.kind == 'wrap' and not i.done()]
+        if wrapping:
+            statuses = self.wrapper.get_status_many([i.psk for i in wrapping])
+            for job in wrapping:
+                status = statuses.get(job.psk)
+                if not isinstance(status, dict) or 'ver_status' not in status:
+                    continue
+                changed = JobWatcher.update_wrap(job, status) or changed
+                if job.done():
+                    self.wrapper.invalidate_cache(job.psk)
+        return changed
+
+    @staticmethod
+    def update_signing(job, resp):
+        status = resp['result']['version']['signing_status']
+        changed = status != job.last_status
+        job.last_status = status
+        if status == 'in_progress':
+            logging.debug('{} - Signing in progress...'.format(job.psk))
+            return changed
+        logging.debug('{} - Signing finished - {}'.format(job.psk, status))
+        job.finish({'status': 200 if status == 'signed' else 500,
+                    'result': resp['result']['version']['signing_status_details']})
+        return True
+
+    @staticmethod
+    def update_wrap(job, status):
+        ver_status = status['ver_status']
+        changed = ver_status != job.last_status
+        job.last_status = ver_status
+        # 0, 1 and 4 can be left over from the last wrap before this one starts, so only trust them on the second check
+        if ver_status in [0, 1, 4]:
+            job.polls += 1
+        if ver_status in [3, -1] or job.polls >= 2:
+            if ver_status in [1, 3, 4]:
+                job.finish({'status': 200, 'result': WRAP_MESSAGES[ver_status]})
+            else:
+                job.finish({'status': 500, 'result': status})
+            return True
+        logging.debug('{} - {}'.format(job.psk, WRAP_MESSAGES.get(ver_status, ver_status)))
+        return changed
@@ -1,26 +1,204 @@
 # coding=utf-8
-import json
-import time
-import datetime
 from helpers import response_check, php_token
+from watcher import JobWatcher, WRAP_MESSAGES
+from cache import cached, invalidate
+
+
+KEEP_CALM = ('com.apperian.keepcalmandcarryon.lol', '')
+
+# Policy number used by the API to the policy key used in the wrap data
+POLICY_CODES = {
+    0: 'ibm_vpn',
+    1: 'data_in_use',
+    2: 'data_at_rest',
+    3: 'rootprotection',
+    4: 'encrypted_checksum_validation',
+    5: 'security_settings_check',
+    6: 'versioncontrol',
+    7: 'iprestriction',
+    8: 'log_blocking',
+    9: 'vpn_config',
+    10: 'checksum_validation',
+    11: 'dynamicauth',
+    12: 'datawipe',
+    13: 'app_usage',
+    14: 'crash_log',
+    15: 'emm_compliance',
+    16: 'device_mdm'
+}
+
+DEFAULT_POLICIES = {
+    'ibm_vpn': 0,
+    'data_in_use': 0,
+    'data_at_rest': 0,
+    'vpn_config': 0,
+    'rootprotection': 0,
+    'security_settings_check': 0,
+    'iprestriction': 0,
+    'log_blocking': 0,
+    'checksum_validation': 0,
+    'encrypted_checksum_validation': 0,
+    'dynamicauth': 0,
+    'datawipe': 0,
+    'app_usage': 0,
+    'crash_log': 0,
+    'versioncontrol': 0,
+    'emm_compliance': 0,
+    'device_mdm': 0,
+    'remotecontrol': 0,
+    'copypaste': 0,
+    'dar': 0,
+    'jailbreak': 0,
+    'geofencing': None,
+    'pin': None,
+    'expiration': None,
+    'fakeloc': None,
+    'vpn': None,
+    'lockout': None,
+    'appfederation': None,
+    'smartfirewall': None
+}
+
+# Dynamic policy rules, in the order they are sent. Each entry is:
+# (policy key, rule name, operation pattern, description, (onsuccess action id, params), (onfail action id, params))
+# Rule names are hardcoded for now, in the future they will be customizable by the admin
+POLICY_RULES = (
+    ('dynamicauth', "Enterprise SSO",
+     "(facts['com.apperian.user.authenticated'])",
+     'Require user authentication for app access.',
+     KEEP_CALM, ('com.apperian.authenticate', '')),
+    ('remotecontrol', "Remote Control",
+     "(true)",
+     'Turn remote control listening on for the app.',
+     ('com.apperian.remotecontrol', ''), KEEP_CALM),
+    ('datawipe', "Datawipe",
+     "(facts['com.apperian.application.datawipe'])",
+     'Wipes all data from an application if requested by an administrator.',
+     ('com.apperian.datawipe', ''), KEEP_CALM),
+    ('app_usage', "App Usage",
+     "(true)",
+     'Tracks the application usage.',
+     ('com.apperian.appusage', ''), KEEP_CALM),
+    ('ibm_vpn', "IBM VPN",
+     "(true)",
+     'Facilitates IBM VPN',
+     ('com.apperian.ibmvpn', ''), KEEP_CALM),
+    ('data_in_use', "Data In Use",
+     "(true)",
+     'Protects application data in memory',
+     KEEP_CALM, KEEP_CALM),
+    ('data_at_rest', "Data At Rest",
+     "(true)",
+     'Protects application data on disk',
+     KEEP_CALM, KEEP_CALM),
+    ('vpn_config', "VPN Config",
+     "(true)",
+     'Configures VPN Apps',
+     KEEP_CALM, KEEP_CALM),
+    ('iprestriction', "IP Restriction",
+     "(true)",
+     'Set IP Restrictions',
+     KEEP_CALM, KEEP_CALM),
+    ('rootprotection', "Root Protection",
+     "(true)",
+     'Prevents rooted devices from running the app',
+     KEEP_CALM, KEEP_CALM),
+    ('security_settings_check', "Security Settings Check",
+     "(true)",
+     'Ensures certain device-level settings are enabled',
+     KEEP_CALM, KEEP_CALM),
+    ('log_blocking', "Log Blocking",
+     "(true)",
+     'Prevents app from writing data to the system log',
+     KEEP_CALM, KEEP_CALM),
+    # if status is 1 run the app and do nothing, else quit the app
+    ('emm_compliance', "EMM Compliance",
+     "(facts['com.apperian.emmcompliance.status'] == 1)",
+     "Makes sure the app only runs when device is EMM Comnpliance.",
+     KEEP_CALM, ('com.apperian.emmcompliance', '')),
+    ('crash_log', "Crash Log Collection",
+     "(true)",
+     'Sends the latest crash data',
+     ('com.apperian.sendcrashlog', ''), KEEP_CALM),
+    ('checksum_validation', "Checksum Validation",
+     "(facts['com.apperian.apps.clientchecksumvalue'] === facts['com.apperian.apps.checksumvalue']) || "
+     "facts['com.apperian.apps.checksumvalue'] === 0",
+     'Informs the server that there has been a checksum mismatch',
+     KEEP_CALM, ('com.apperian.sendchecksummismatch', '')),
+    ('encrypted_checksum_validation', "Encrypted Checksum Validation",
+     "(true)",
+     'Informs the server that there has been a checksum mismatch with Secure Element',
+     KEEP_CALM, KEEP_CALM),
+    # If com.apperian.application.version is undefined, this is an older version of the wrapper which doesn't
+    # have the version_psk baked in. Therefore, we use what the system has. If the app has the version psk
+    # baked in, always use that because it's always accurate.
+    ('versioncontrol', "Version Control",
+     "((typeof(facts['com.apperian.application.version']) === 'undefined' && "
+     "facts['com.apperian.apps.installedversion'] !== -1 && "
+     "facts['com.apperian.apps.latestversion'] > "
+     "facts['com.apperian.apps.installedversion']) || "
+     "(facts['com.apperian.apps.latestversion'] > "
+     "facts['com.apperian.application.version']))",
+     'Check whether the application is up to date.',
+     ('com.apperian.update', ''), KEEP_CALM),
+    ('device_mdm', "Device MDM",
+     "(facts['com.apperian.device.mdm_enrolled'])",
+     'Makes sure the app only runs when device is under any MDM Enrollment.',
+     KEEP_CALM,
+     ('com.apperian.block', '{"block_reason": "This device is not enrolled in MDM. Contact your administrator to '
+                            'enroll your device so you can run this app."}')),
+)
+
+# Rule name to policy key, used to match the rules already stored on the server
+RULE_KEYS = dict((rule[1], rule[0]) for rule in POLICY_RULES)
+
+# Rule fields compared to decide if a policy has changed. psk is left out since it is only set by the server
+RULE_FIELDS = ('name', 'operationpattern', 'description', 'actions', 'ruleparams')
 
 
 class Wrapper:
-    def __init__(self, php_session, php_payload, app_obj, region, user_psk):
+    def __init__(self, php_session, rpc, app_obj, region, user_psk, cache=None):
+        """
+        :param cache: Optional. ResponseCache for the version psks, dynamic policies and wrap status that wrap() and
+            unwrap() read. Pass the same one as Apps so its update() and sign() drop stale entries. Nothing is
+            cached if not given
+        """
         self.session = php_session
-        self.payload = php_payload
+        self.rpc = rpc
         self.user_psk = user_psk
         self.app_obj = app_obj
         self.region = region
-        self.session.headers.update({'X-Ds-Client-Type': 9, 'X-HTTP-Token': php_token})
+        self.cache = cache
+        self.watcher = JobWatcher(wrapper=self)
+        self.session.headers.update({'X-Ds-Client-Type': '9', 'X-HTTP-Token': php_token})
         # headers['Content-Type'] = 'application/json'
 
-    def wrap(self, psk, policies, async=False):
-        resp = self.app_obj.get_details(psk)
-        version_psk = resp['result']['version']['psk']
+    def wrap(self, psk, policies, async=False, timeout=None, force=False):
+        """
+        :param psk: Unique ID of the app to wrap
+        :param policies: List of policy numbers to apply. See convert_policies()
+        :param async: Optional. If True, only check the status once instead of waiting for the wrap to finish. A
+            wrap that is still running returns a 202. Use watcher.watch_wrap(psk) to wait for it later
+        :param timeout: Optional. Seconds to wait for wrapping to finish before giving up with a 408
+        :param force: Optional. If True, wrap and save the policies even if the app is already wrapped with the same
+            policies
+        :return: Dict with the status and result of the wrap. If the app is already wrapped with the same policies,
+            nothing is sent and the dict also has 'skipped': True
+        """
+        resp = Wrapper.get_version_psk(self, psk)
+        if resp['status'] != 200:
+            return resp
+        version_psk = resp['result']
         converted_policies = Wrapper.convert_policies(policies)
-        dynamic_policy_info = Wrapper.gen_dynamic_policy_info(self, converted_policies, psk, version_psk)
-        wrapper_status = Wrapper.get_status(self, psk)
+        dynamic_policy_info = Wrapper.gen_dynamic_policy_info(self, converted_policies, psk, version_psk, force)
+        resp = Wrapper.get_wrap_info(self, psk)
+        if resp['status'] != 200:
+            return resp
+        wrapper_status = resp['result']
+        if not force and dynamic_policy_info['policy_data']['action'] == 'nothing' and \
+                wrapper_status['ver_status'] in [1, 3]:
+            # Already wrapped with these policies, skip sending the app back to the wrap queue
+            return {'status': 200, 'result': 'Policies unchanged, wrap skipped', 'skipped': True}
         wrapper_version = wrapper_status['apperian_wrapper_info']['wrapper_version']
         params = {
             'appPsk': psk,
@@ -28,140 +206,133 @@ class Wrapper:
             'dynamicPolicyInfo': dynamic_policy_info,
             'apperianWrapperVersion': wrapper_version,
             'userPsk': self.user_psk,
-            'pythonAuthToken': self.payload['params']['token']
+            'pythonAuthToken': self.rpc.token
         }
-        # params['pythonAuthToken'] = web_svc.auth_token
-        self.payload['params'].update(params)
-        self.payload['method'] = 'com.apperian.eas.apps.wrapappasync'
-        self.session.post(self.region['PHP Web Services'], data=json.dumps(self.payload))
-
-        message = {
-            -1: "Error applying policies",
-            0: "Wrapping completed, no policies applied",
-            1: "Policies applied",
-            2: "Wrapping in progress...",
-            3: "Wrapping completed, pending signing",
-            4: "Wrapping completed, no policies applied"}
-
-        done_wrapping = False
-        count = 1
-        while not done_wrapping and count < 3:
-            if async:
-                wrap_status_result = Wrapper.get_status(self, psk)
-                if wrap_status_result['ver_status'] not in [0, 4]:
-                    done_wrapping = True
-                else:
-                    break
-            else:
-                wrap_status_result = Wrapper.get_status(self, psk)
-                ts = time.time()
-                st = datetime.datetime.fromtimestamp(ts).strftime('%H:%M:%S')
-                if wrap_status_result['ver_status'] in [1, 2]:
-                    print("{0} - {1}".format(st, message[wrap_status_result['ver_status']]))
-                elif wrap_status_result['ver_status'] in [3, -1]:
-                    done_wrapping = True
-                else:
-                    count += 1
-
-                if not done_wrapping:
-                    time.sleep(10)
+        resp = self.rpc.call('com.apperian.eas.apps.wrapappasync', params)
+        Wrapper.invalidate_cache(self, psk)
+        if resp['status'] != 200:
+            return resp
+
+        if not async:
+            return self.watcher.watch_wrap(psk, timeout).wait()
 
+        wrap_status_result = Wrapper.get_status(self, psk)
         if wrap_status_result['ver_status'] in [1, 3, 4]:
-            return {'status': 200, 'result': message[wrap_status_result['ver_status']]}
+            return {'status': 200, 'result': WRAP_MESSAGES[wrap_status_result['ver_status']]}
+        elif wrap_status_result['ver_status'] == 2:
+            return {'status': 202, 'result': WRAP_MESSAGES[2]}
         else:
             return {'status': 500, 'result': wrap_status_result}
 
     def unwrap(self, app_psk, version_psk):
+        response = Wrapper.get_policy(self, app_psk, version_psk)
+        if response['status'] != 200 or not response['result'].get('policies'):
+            return response
+
+        policy_psk = response['result']['policies'][0]['psk']
+        params = {
+            'appPsk': app_psk,
+            'dynamicPolicyInfo': {
+                'action': 'delete',
+                'policy_data': {
+                    'versionpsk': version_psk,
+                    'policy_psk': policy_psk}
+            },
+            'pythonAuthToken': self.rpc.token
+        }
+        response = self.rpc.call('com.apperian.eas.apps.unwrapapp', params)
+        Wrapper.invalidate_cache(self, app_psk)
+        return response
+
+    @cached('wrapping.version')
+    def get_version_psk(self, app_psk):
+        """
+        :param app_psk: Unique ID of the app
+        :return: Dict with the status and, as result, the psk of the app's latest version
+        """
+        resp = self.app_obj.get_details(app_psk)
+        if resp['status'] != 200:
+            return resp
+        return {'status': 200, 'result': resp['result']['version']['psk']}
+
+    @cached('wrapping.policy')
+    def get_policy(self, app_psk, version_psk):
+        """
+        :param app_psk: Unique ID of the app, used to invalidate the policies of all its versions at once
+        :param version_psk: Unique ID of the app version
+        :return: Dict with the status and result of the version's dynamic policy document
+        """
         url = '{}/policies/dynamic/policy/version/{}'.format(self.region['Python Web Services'], version_psk)
-        response = self.app_obj.session.get(url)
-        if len(response['policies']) != 0:
-            policy_psk = response['policies'][0]['psk']
-
-            self.session['params'].update({
-                'appPsk': app_psk,
-                'dynamicPolicyInfo': {
-                    'action': 'delete',
-                    'policy_data': {
-                        'versionpsk': version_psk,
-                        'policy_psk': policy_psk}
-                },
-                'pythonAuthToken': self.session['params']['token']
-            })
-
-            self.payload['method'] = 'com.apperian.eas.apps.unwrapapp'
-            self.session.post(self.region['PHP Web Services'], data=json.dumps(self.payload))
+        return response_check(self.app_obj.session.get(url))
+
+    @cached('wrapping.status')
+    def get_wrap_info(self, app_psk):
+        """
+        :param app_psk: Unique ID of the app
+        :return: Dict with the status and, as result, the same dict get_status() returns
+        """
+        return self.rpc.call('com.apperian.eas.apps.getversionstatus', {'appPsk': app_psk}, 'result')
+
+    def invalidate_cache(self, app_psk):
+        """
+        Drops the cached policies and wrap status of the app. Called whenever a wrap or unwrap is sent and when a
+        wrap finishes. The version psk is kept since wrapping does not change it
+        """
+        invalidate(self.cache, 'wrapping.policy', app_psk)
+        invalidate(self.cache, 'wrapping.status', app_psk)
 
     @staticmethod
     def convert_policies(policies):
-        conversion = {
-            0: 'ibm_vpn',
-            1: 'data_in_use',
-            2: 'data_at_rest',
-            3: 'rootprotection',
-            4: 'encrypted_checksum_validation',
-            5: 'security_settings_check',
-            6: 'versioncontrol',
-            7: 'iprestriction',
-            8: 'log_blocking',
-            9: 'vpn_config',
-            10: 'checksum_validation',
-            11: 'dynamicauth',
-            12: 'datawipe',
-            13: 'app_usage',
-            14: 'crash_log',
-            15: 'emm_compliance',
-            16: 'device_mdm'
-        }
-        policy_list = {
-            'ibm_vpn': 0,
-            'data_in_use': 0,
-            'data_at_rest': 0,
-            'vpn_config': 0,
-            'rootprotection': 0,
-            'security_settings_check': 0,
-            'iprestriction': 0,
-            'log_blocking': 0,
-            'checksum_validation': 0,
-            'encrypted_checksum_validation': 0,
-            'dynamicauth': 0,
-            'datawipe': 0,
-            'app_usage': 0,
-            'crash_log': 0,
-            'versioncontrol': 0,
-            'emm_compliance': 0,
-            'device_mdm': 0,
-            'remotecontrol': 0,
-            'copypaste': 0,
-            'dar': 0,
-            'jailbreak': 0,
-            'geofencing': None,
-            'pin': None,
-            'expiration': None,
-            'fakeloc': None,
-            'vpn': None,
-            'lockout': None,
-            'appfederation': None,
-            'smartfirewall': None
-        }
+        policy_list = dict(DEFAULT_POLICIES)
         for i in policies:
-            if policy_list[conversion[i]] == 0:
-                policy_list[conversion[i]] = 1
+            if policy_list[POLICY_CODES[i]] == 0:
+                policy_list[POLICY_CODES[i]] = 1
             else:
-                policy_list[conversion[i]] = True
+                policy_list[POLICY_CODES[i]] = True
 
         return policy_list
 
-    def gen_dynamic_policy_info(self, policies, app_psk, version_psk):
-        r = self.session.get('{}/policies/dynamic/policy/version/{}'.format(
-            self.region['PHP Web Services'], version_psk))
-        policy_response = response_check(r)
+    def gen_dynamic_policy_info(self, policies, app_psk, version_psk, force=False):
+        policy_response = Wrapper.get_policy(self, app_psk, version_psk)
         if policy_response['status'] == 200:
             policy_response = policy_response['result']
 
+        return Wrapper.build_policy_info(policies, app_psk, version_psk, policy_response, force)
+
+    @staticmethod
+    def build_rules(policies, policy_keys):
+        """
+        :param policies: Dict returned by convert_policies()
+        :param policy_keys: Dict of policy key to the matching rule already stored on the server
+        :return: List of rule dicts for every enabled policy, stamped with the psk of the existing rule if any
+        """
+        rules = []
+        for key, name, operation_pattern, description, on_success, on_fail in POLICY_RULES:
+            if policies[key] == 1:
+                rule = {'name': name,
+                        'operationpattern': operation_pattern,
+                        'description': description,
+                        'actions': {'onsuccess': [{'id': on_success[0], 'params': on_success[1]}],
+                                    'onfail': [{'id': on_fail[0], 'params': on_fail[1]}]},
+                        'ruleparams': {}}
+                if key in policy_keys:
+                    rule['psk'] = policy_keys[key]['psk']
+                rules.append(rule)
+        return rules
+
+    @staticmethod
+    def build_policy_info(policies, app_psk, version_psk, policy_response, force=False):
+        """
+        :param policies: Dict returned by convert_policies()
+        :param app_psk: Unique ID of the app
+        :param version_psk: Unique ID of the app version
+        :param policy_response: Current dynamic policy of the version, as returned by the policies endpoint
+        :param force: Optional. If True, save the policy even if its rules are the same as the ones on the server
+        :return: Dict with the dynamicPolicyInfo to send with the wrap
+        """
         policy_name = "MyDynamicPolicy_appPsk{0}".format(app_psk)
 
         policy_description = "Placeholder description for app psk {0}".format(app_psk)
-        rules = []
 
         if 'policies' not in policy_response:
             new_policy = True
@@ -171,312 +342,15 @@ class Wrapper:
             new_policy = True
 
         policy_keys = {}
-
-        if 'policies' not in policy_response:
-            current_rules = []
-        elif len(policy_response['policies']) > 0:
+        if not new_policy:
             current_rules = policy_response['policies'][0]['rules']
-        else:
-            current_rules = []
-
-        # Hardcoded rule name for now, in the future it will be customizable by the admin
-        rule_names = {
-            'dynamicauth': "Enterprise SSO",
-            'remotecontrol': "Remote Control",
-            'datawipe': "Datawipe",
-            'app_usage': "App Usage",
-            'versioncontrol': "Version Control",
-            'emm_compliance': "EMM Compliance",
-            'crash_log': "Crash Log Collection",
-            'checksum_validation': "Checksum Validation",
-            'ibm_vpn': "IBM VPN",
-            'data_in_use': "Data In Use",
-            'data_at_rest': "Data At Rest",
-            'vpn_config': "VPN Config",
-            'iprestriction': "IP Restriction",
-            'rootprotection': "Root Protection",
-            'security_settings_check': "Security Settings Check",
-            'log_blocking': "Log Blocking",
-            'encrypted_checksum_validation': "Encrypted Checksum Validation",
-            'device_mdm': "Device MDM"
-        }
+            policy_keys = dict((RULE_KEYS[x['name']], x) for x in current_rules if x['name'] in RULE_KEYS)
 
-        if not new_policy:
-            policy_keys = {y[0]: x for x in current_rules for y in rule_names.iteritems() if x['name'] == y[1]}
-
-        action_prefix = 'com.apperian.'
-
-        # Dynamic Auth policy
-        if policies['dynamicauth'] == 1:
-            operation_pattern = "(facts['com.apperian.user.authenticated'])"
-            actions_success = [{'id': "{0}keepcalmandcarryon.lol".format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': "{0}authenticate".format(action_prefix), 'params': ''}]
-            dynamicauth_rule = {'name': rule_names['dynamicauth'],
-                                'operationpattern': operation_pattern,
-                                'description': 'Require user authentication for app access.',
-                                'actions': {'onsuccess': actions_success,
-                                            'onfail': actions_fail}, 'ruleparams': {}}
-            if 'dynamicauth' in policy_keys:
-                dynamicauth_rule['psk'] = policy_keys['dynamicauth']['psk']
-            rules.append(dynamicauth_rule)
-
-        # Remote Control Policy
-        if policies['remotecontrol'] == 1:
-            operation_pattern = "(true)"
-            actions_success = [{'id': "{0}remotecontrol".format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': "{0}keepcalmandcarryon.lol".format(action_prefix), 'params': ''}]
-            remotecontrol_rule = {'name': rule_names['remotecontrol'],
-                                  'operationpattern': operation_pattern,
-                                  'description': 'Turn remote control listening on for the app.',
-                                  'actions': {'onsuccess': actions_success,
-                                              'onfail': actions_fail}, 'ruleparams': {}}
-            if 'remotecontrol' in policy_keys:
-                remotecontrol_rule['psk'] = current_rules[policy_keys['remotecontrol']]['psk']
-            rules.append(remotecontrol_rule)
-
-        # Datawipe Policy
-        if policies['datawipe'] == 1:
-            operation_pattern = "(facts['com.apperian.application.datawipe'])"
-            actions_success = [{'id': "{0}datawipe".format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': "{0}keepcalmandcarryon.lol".format(action_prefix), 'params': ''}]
-            datawipe_rule = {'name': rule_names['datawipe'],
-                             'operationpattern': operation_pattern,
-                             'description': 'Wipes all data from an application if requested by an administrator.',
-                             'actions': {'onsuccess': actions_success, 'onfail': actions_fail}, 'ruleparams': {}}
-            if 'datawipe' in policy_keys:
-                datawipe_rule['psk'] = current_rules[policy_keys['datawipe']]['psk']
-            rules.append(datawipe_rule)
-
-        # App Usage Policy
-        if policies['app_usage'] == 1:
-            operation_pattern = "(true)"
-            # on success and failure we do the same thing which is "do nothing"
-            actions_success = [{'id': "{0}appusage".format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': "{0}keepcalmandcarryon.lol".format(action_prefix), 'params': ''}]
-            app_usage_rule = {'name': rule_names['app_usage'],
-                              'operationpattern': operation_pattern,
-                              'description': 'Tracks the application usage.',
-                              'actions': {'onsuccess': actions_success, 'onfail': actions_fail}, 'ruleparams': {}}
-            if 'app_usage' in policy_keys:
-                app_usage_rule['psk'] = policy_keys['app_usage']['psk']
-            rules.append(app_usage_rule)
-
-        # IBM VPN Policy
-        if policies['ibm_vpn'] == 1:
-            operation_pattern = "(true)"
-            # on success and failure we do the same thing which is "do nothing"
-            actions_success = [{'id': '{0}ibmvpn'.format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            ibm_vpn_usage_rule = {'name': rule_names['ibm_vpn'],
-                                  'operationpattern': operation_pattern,
-                                  'description': 'Facilitates IBM VPN',
-                                  'actions': {'onsuccess': actions_success, 'onfail': actions_fail}, 'ruleparams': {}}
-            if 'ibm_vpn' in policy_keys:
-                ibm_vpn_usage_rule['psk'] = policy_keys['ibm_vpn']['psk']
-            rules.append(ibm_vpn_usage_rule)
-
-        # Data in Use Encryption policy
-        if policies['data_in_use'] == 1:
-            operation_pattern = "(true)"
-            # on success and failure we do the same thing which is "do nothing"
-            actions_success = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            data_in_use_usage_rule = {'name': rule_names['data_in_use'],
-                                      'operationpattern': operation_pattern,
-                                      'description': 'Protects application data in memory',
-                                      'actions': {'onsuccess': actions_success, 'onfail': actions_fail},
-                                      'ruleparams': {}}
-            if 'data_in_use' in policy_keys:
-                data_in_use_usage_rule['psk'] = policy_keys['data_in_use']['psk']
-            rules.append(data_in_use_usage_rule)
-
-        # Data at Rest Encryption policy
-        if policies['data_at_rest'] == 1:
-            operation_pattern = "(true)"
-            # on success and failure we do the same thing which is "do nothing"
-            actions_success = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            data_at_rest_usage_rule = {'name': rule_names['data_at_rest'],
-                                       'operationpattern': operation_pattern,
-                                       'description': 'Protects application data on disk',
-                                       'actions': {'onsuccess': actions_success, 'onfail': actions_fail},
-                                       'ruleparams': {}}
-            if 'data_at_rest' in policy_keys:
-                data_at_rest_usage_rule['psk'] = policy_keys['data_at_rest']['psk']
-            rules.append(data_at_rest_usage_rule)
-
-        # VPN Configuration Policy
-        if policies['vpn_config'] == 1:
-            operation_pattern = "(true)"
-            # on success and failure we do the same thing which is "do nothing"
-            actions_success = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            vpn_config_usage_rule = {'name': rule_names['vpn_config'],
-                                     'operationpattern': operation_pattern,
-                                     'description': 'Configures VPN Apps',
-                                     'actions': {'onsuccess': actions_success, 'onfail': actions_fail},
-                                     'ruleparams': {}}
-            if 'vpn_config' in policy_keys:
-                vpn_config_usage_rule['psk'] = policy_keys['vpn_config']['psk']
-            rules.append(vpn_config_usage_rule)
-
-        # IP Restriction Policy
-        if policies['iprestriction'] == 1:
-            operation_pattern = "(true)"
-            # on success and failure we do the same thing which is "do nothing"
-            actions_success = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            iprestriction_usage_rule = {'name': rule_names['iprestriction'],
-                                        'operationpattern': operation_pattern,
-                                        'description': 'Set IP Restrictions',
-                                        'actions': {'onsuccess': actions_success, 'onfail': actions_fail},
-                                        'ruleparams': {}}
-            if 'iprestriction' in policy_keys:
-                iprestriction_usage_rule['psk'] = policy_keys['iprestriction']['psk']
-            rules.append(iprestriction_usage_rule)
-
-        # Root Protection Policy
-        if policies['rootprotection'] == 1:
-            operation_pattern = "(true)"
-            # on success and failure we do the same thing which is "do nothing"
-            actions_success = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            rootprotection_usage_rule = {'name': rule_names['rootprotection'],
-                                         'operationpattern': operation_pattern,
-                                         'description': 'Prevents rooted devices from running the app',
-                                         'actions': {'onsuccess': actions_success, 'onfail': actions_fail},
-                                         'ruleparams': {}}
-            if 'rootprotection' in policy_keys:
-                rootprotection_usage_rule['psk'] = policy_keys['rootprotection']['psk']
-            rules.append(rootprotection_usage_rule)
-
-        # Security Settings Check
-        if policies['security_settings_check'] == 1:
-            operation_pattern = "(true)"
-            # on success and failure we do the same thing which is "do nothing"
-            actions_success = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            security_settings_check_usage_rule = {'name': rule_names['security_settings_check'],
-                                                  'operationpattern': operation_pattern,
-                                                  'description': 'Ensures certain device-level settings are enabled',
-                                                  'actions': {'onsuccess': actions_success, 'onfail': actions_fail},
-                                                  'ruleparams': {}}
-            if 'security_settings_check' in policy_keys:
-                security_settings_check_usage_rule['psk'] = policy_keys['security_settings_check']['psk']
-            rules.append(security_settings_check_usage_rule)
-
-        # Log Blocking Policy
-        if policies['log_blocking'] == 1:
-            operation_pattern = "(true)"
-            # on success and failure we do the same thing which is "do nothing"
-            actions_success = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            log_blocking_usage_rule = {'name': rule_names['log_blocking'],
-                                       'operationpattern': operation_pattern,
-                                       'description': 'Prevents app from writing data to the system log',
-                                       'actions': {'onsuccess': actions_success, 'onfail': actions_fail},
-                                       'ruleparams': {}}
-            if 'log_blocking' in policy_keys:
-                log_blocking_usage_rule['psk'] = policy_keys['log_blocking']['psk']
-            rules.append(log_blocking_usage_rule)
-
-        # EMM Compliance Policy
-        if policies['emm_compliance'] == 1:
-            # if status is 1 run the app and do nothiing, else quit the app
-            operation_pattern = "(facts['com.apperian.emmcompliance.status'] == 1)"
-            actions_success = [{"id": '{0}keepcalmandcarryon.lol'.format(action_prefix), "params": ''}]
-            actions_fail = [{"id": "{0}emmcompliance".format(action_prefix), "params": ''}]
-            emm_compliance_rule = {"name": rule_names['emm_compliance'],
-                                   "operationpattern": operation_pattern,
-                                   "description": "Makes sure the app only runs when device is EMM Comnpliance.",
-                                   "actions": {"onsuccess": actions_success, "onfail": actions_fail},
-                                   "ruleparams": {}}
-            if "emm_compliance" in policy_keys:
-                emm_compliance_rule["psk"] = policy_keys["emm_compliance"]["psk"]
-            rules.append(emm_compliance_rule)
-
-        # Crash log policy
-        if policies['crash_log'] == 1:
-            operation_pattern = "(true)"
-            # on success and failure we do the same thing which is "do nothing"
-            actions_success = [{'id': '{0}sendcrashlog'.format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            crash_log_rule = {'name': rule_names['crash_log'],
-                              'operationpattern': operation_pattern,
-                              'description': 'Sends the latest crash data',
-                              'actions': {'onsuccess': actions_success, 'onfail': actions_fail}, 'ruleparams': {}}
-            if 'crash_log' in policy_keys:
-                crash_log_rule['psk'] = policy_keys['crash_log']['psk']
-            rules.append(crash_log_rule)
-
-        # Checksum validation policy
-        if policies['checksum_validation'] == 1:
-            operation_pattern = "(facts['com.apperian.apps.clientchecksumvalue'] === facts['com.apperian.apps." \
-                                "checksumvalue']) || facts['com.apperian.apps.checksumvalue'] === 0"
-            # on success we "do nothing"
-            actions_success = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': '{0}sendchecksummismatch'.format(action_prefix), 'params': ''}]
-            checksum_validation_rule = {'name': rule_names['checksum_validation'],
-                                        'operationpattern': operation_pattern,
-                                        'description': 'Informs the server that there has been a checksum mismatch',
-                                        'actions': {'onsuccess': actions_success, 'onfail': actions_fail},
-                                        'ruleparams': {}}
-            if 'checksum_validation' in policy_keys:
-                checksum_validation_rule['psk'] = policy_keys['checksum_validation']['psk']
-            rules.append(checksum_validation_rule)
-
-        # Encrypted checksum validation policy
-        if policies['encrypted_checksum_validation'] == 1:
-            operation_pattern = "(true)"
-            # on success and failure we do the same thing which is "do nothing"
-            actions_success = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            actions_fail = [{'id': '{0}keepcalmandcarryon.lol'.format(action_prefix), 'params': ''}]
-            encrypted_checksum_validation_rule = {'name': rule_names['encrypted_checksum_validation'],
-                                                  'operationpattern': operation_pattern,
-                                                  'description': 'Informs the server that there has been a checksum mismatch with Secure Element',
-                                                  'actions': {'onsuccess': actions_success, 'onfail': actions_fail},
-                                                  'ruleparams': {}}
-            if 'encrypted_checksum_validation' in policy_keys:
-                encrypted_checksum_validation_rule['psk'] = policy_keys['encrypted_checksum_validation']['psk']
-            rules.append(encrypted_checksum_validation_rule)
-
-        # Version Control Policy
-        if policies['versioncontrol'] == 1:
-            # If com.apperian.application.version is undefined, this is an older version of the wrapper which doesn't
-            # have the version_psk baked in. Therefore, we use what the system has. If the app has the version psk
-            # baked in, always use that because it's always accurate.
-            operation_pattern = "((typeof(facts['com.apperian.application.version']) === 'undefined' && " \
-                                "facts['com.apperian.apps.installedversion'] !== -1 && " \
-                                "facts['com.apperian.apps.latestversion'] > " \
-                                "facts['com.apperian.apps.installedversion']) || " \
-                                "(facts['com.apperian.apps.latestversion'] > " \
-                                "facts['com.apperian.application.version']))"
-            actions_fail = [{"id": '{0}keepcalmandcarryon.lol'.format(action_prefix), "params": ''}]
-            actions_success = [{"id": '{0}update'.format(action_prefix), "params": ''}]
-            versioncontrol_rule = {"name": rule_names['versioncontrol'], "operationpattern": operation_pattern,
-                                   "description": 'Check whether the application is up to date.',
-                                   "actions": {"onsuccess": actions_success,
-                                               "onfail": actions_fail},
-                                   "ruleparams": {}}
-            if 'versioncontrol' in policy_keys:
-                versioncontrol_rule['psk'] = policy_keys['versioncontrol']['psk']
-            rules.append(versioncontrol_rule)
-
-        # Device MDM Policy
-        if policies['device_mdm'] == 1:
-            operation_pattern = "(facts['com.apperian.device.mdm_enrolled'])"
-            actions_success = [{'id': "{0}keepcalmandcarryon.lol".format(action_prefix), 'params': ''}]
-            actions_fail = [{
-                'id': "{0}block".format(action_prefix),
-                'params': '{"block_reason": "This device is not enrolled in MDM. Contact your administrator to enroll your device so you can run this app."}'
-            }]
-            device_mdm_rule = {'name': rule_names['device_mdm'],
-                               'operationpattern': operation_pattern,
-                               'description': 'Makes sure the app only runs when device is under any MDM Enrollment.',
-                               'actions': {'onsuccess': actions_success, 'onfail': actions_fail}, 'ruleparams': {}}
-            if 'device_mdm' in policy_keys:
-                device_mdm_rule['psk'] = policy_keys['device_mdm']['psk']
-            rules.append(device_mdm_rule)
+        rules = Wrapper.build_rules(policies, policy_keys)
+
+        if rules and not new_policy and not force and Wrapper.rules_match(rules, current_rules):
+            # Same rules as the policy already on the version, there is nothing to save
+            return {'policy_data': {'action': 'nothing', 'policy_data': None}}
 
         policy_op_pattern = Wrapper.format_policies(rules)
 
@@ -513,6 +387,27 @@ class Wrapper:
                                                  'operationpattern': policy_op_pattern, 'rules': rules}
         return {'policy_data': return_policy_info}
 
+    @staticmethod
+    def rules_match(rules, current_rules):
+        """
+        :param rules: List of rule dicts returned by build_rules()
+        :param current_rules: List of rule dicts of the policy already stored on the server
+        :return: True if both have the same rules, ignoring order and psks
+        """
+        if len(rules) != len(current_rules):
+            return False
+        current = dict((i.get('name'), i) for i in current_rules)
+        # Stops at the first difference, so a changed policy costs little more than the wrap it goes on to build
+        for rule in rules:
+            other = current.get(rule['name'])
+            if other is None:
+                return False
+            for field in RULE_FIELDS:
+                # PHP sends empty dicts back as empty lists, so treat all empty values the same
+                if (rule[field] or None) != (other.get(field) or None):
+                    return False
+        return True
+
     @staticmethod
     def format_policies(rules):
         # Takes in an array of rule objects, each containing the 'name' key, and
@@ -538,9 +433,16 @@ class Wrapper:
               "apperian_wrapper_info" => $apperianWrapperInfo}
         """
 
-        self.payload['method'] = 'com.apperian.eas.apps.getversionstatus'
-        self.payload['params'].update({'appPsk': app_psk})
-
-        resp = self.session.post(self.region['PHP Web Services'], data=json.dumps(self.payload))
-        resp = response_check(resp, 'result')
+        resp = self.rpc.call('com.apperian.eas.apps.getversionstatus', {'appPsk': app_psk}, 'result')
         return resp['result']
+
+    def get_status_many(self, app_psks):
+        """
+        Same as get_status() for many apps, sent as JSON-RPC batches so it only takes a few requests
+
+        :param app_psks: List of app psks
+        :return: Dict of app psk to the status dict get_status() would have returned
+        """
+        app_psks = list(app_psks)
+        calls = [('com.apperian.eas.apps.getversionstatus', {'appPsk': i}, 'result') for i in app_psks]
+        return dict((psk, resp['result']) for psk, resp in zip(app_psks, self.rpc.batch(calls)))
@@ -0,0 +1,55 @@
+# coding=utf-8
+"""
+Compares the JSON libraries codec can use on payloads like the ones the connectors send and receive: a wrap call
+with its dynamic policy, and large user and app list responses. Libraries that are not installed are skipped.
+
+Run from the repository root: python benchmarks/codec.py
+"""
+import sys
+import timeit
+sys.path.insert(0, 'apperian/modules')
+
+import codec
+from wrapping import Wrapper
+
+
+def wrap_payload():
+    policies = Wrapper.convert_policies(range(17))
+    return {'id': 1, 'apiVersion': '1.0', 'method': 'com.apperian.eas.apps.wrapappasync', 'jsonrpc': '2.0',
+            'params': {'token': 'x' * 40, 'appPsk': 1234, 'data': policies, 'userPsk': 5678,
+                       'dynamicPolicyInfo': Wrapper.build_policy_info(policies, 1234, 4321, {}),
+                       'apperianWrapperVersion': '3.2.1', 'pythonAuthToken': 'x' * 40}}
+
+
+def users_response(count=20000):
+    return {'users': [{'psk': i, 'id': 'user{}@example.com'.format(i), 'first_name': 'First{}'.format(i),
+                       'last_name': 'Last{}'.format(i), 'email': 'user{}@example.com'.format(i), 'role': 'user',
+                       'deleted': False, 'disabled_reason': None, 'created_date': '2017-01-01T00:00:00',
+                       'modified_date': '2017-06-01T00:00:00'} for i in range(count)]}
+
+
+def apps_response(count=5000):
+    return {'id': 1, 'jsonrpc': '2.0', 'result': {'status': 'ok', 'applications': [
+        {'ID': i, 'author': 'Author {}'.format(i), 'bundleID': 'com.example.app{}'.format(i),
+         'longdescription': u'Long description of app {} – with unicode '.format(i) * 4,
+         'shortdescription': 'App {}'.format(i), 'status': 1, 'type': 'iOS', 'version': '1.0.{}'.format(i),
+         'versionNotes': 'https://example.com/notes/{}'.format(i)} for i in range(count)]}}
+
+
+def main():
+    payloads = [('wrap payload', wrap_payload(), 2000), ('user list', users_response(), 5),
+                ('app list', apps_response(), 5)]
+    libraries = [lib for lib in [codec.load(i) for i in codec.LIBRARIES + ['json']] if lib]
+    print('Selected by default: {}'.format(codec.NAME))
+    print('{:<14} {:<12} {:>12} {:>12}'.format('payload', 'library', 'dumps ms', 'loads ms'))
+    for label, payload, number in payloads:
+        text = codec.select(['json'])[1](payload)
+        for name, dumps, loads in libraries:
+            assert loads(dumps(payload)) == loads(text)
+            dump_time = timeit.timeit(lambda: dumps(payload), number=number) / number * 1000
+            load_time = timeit.timeit(lambda: loads(text), number=number) / number * 1000
+            print('{:<14} {:<12} {:>12.3f} {:>12.3f}'.format(label, name, dump_time, load_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# coding=utf-8
+"""
+Compares helpers.response_check reading the whole body with codec against stream=True, which only decodes the
+value at the requested keys with the standard library. Uses multi-megabyte synthetic user and app lists, each
+next to an unrelated list of the same size. Each case runs in its own process so the peak memory of the two modes
+can be compared.
+
+Run from the repository root: python benchmarks/response_check.py
+"""
+import sys
+import os
+import json
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+sys.path.insert(0, 'apperian/modules')
+
+from helpers import response_check
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+        self.status_code = 200
+
+    @property
+    def content(self):
+        return self.body
+
+    @property
+    def text(self):
+        return self.body.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.body)
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+def users_body(count):
+    users = [{'psk': i, 'id': 'user{}@example.com'.format(i), 'first_name': 'First{}'.format(i),
+              'last_name': 'Last{}'.format(i), 'email': 'user{}@example.com'.format(i), 'role': 'user',
+              'mobile_phone': '555-{:04d}'.format(i % 10000), 'deleted': False, 'disabled_reason': None,
+              'created_date': '2017-01-01T00:00:00', 'modified_date': '2017-06-01T00:00:00',
+              'until_date': None, 'last_login_from_catalog': None} for i in range(count)]
+    return json.dumps({'audit': users, 'users': users}).encode('utf-8')
+
+
+def apps_body(count):
+    apps = [{'ID': i, 'author': 'Author {}'.format(i), 'bundleID': 'com.example.app{}'.format(i),
+             'longdescription': 'Long description of app {} '.format(i) * 4, 'shortdescription': 'App {}'.format(i),
+             'status': 1, 'type': 'iOS', 'version': '1.0.{}'.format(i), 'versionNotes': 'Notes'} for i in range(count)]
+    return json.dumps({'id': 1, 'jsonrpc': '2.0', 'result': {'status': 'ok', 'archived': apps,
+                                                             'applications': apps}}).encode('utf-8')
+
+
+# Case name to (function building the body, number of items, keys of the list)
+CASES = {'users': (users_body, 50000, ('users',)), 'apps': (apps_body, 20000, ('result', 'applications'))}
+
+
+def run(case, mode, body_file, repeat=3):
+    with open(body_file, 'rb') as f:
+        body = f.read()
+    path = CASES[case][2]
+    # Baseline rss once the body is loaded, so only the parsing is counted
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    for i in range(repeat):
+        resp = response_check(FakeResponse(body), *path, stream=mode == 'stream')
+        assert resp['status'] == 200 and len(resp['result']) == CASES[case][1]
+        del resp
+    seconds = (time.time() - start) / repeat
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+    print('{} {} {:.1f} {:.3f} {}'.format(case, mode, len(body) / 1e6, seconds, peak))
+
+
+def main():
+    print('{:<6} {:<7} {:>8} {:>10} {:>12}'.format('case', 'mode', 'MB', 'seconds', 'peak rss KB'))
+    tmp = tempfile.mkdtemp()
+    try:
+        for case in sorted(CASES):
+            body_file = os.path.join(tmp, case + '.json')
+            with open(body_file, 'wb') as f:
+                f.write(CASES[case][0](CASES[case][1]))
+            for mode in ['json', 'stream']:
+                out = subprocess.check_output([sys.executable, __file__, case, mode, body_file]).decode().split()
+                print('{:<6} {:<7} {:>8} {:>10} {:>12}'.format(*out))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        run(*sys.argv[1:])
+    else:
+        main()
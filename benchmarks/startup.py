@@ -0,0 +1,92 @@
+# coding=utf-8
+"""
+Measures cold start: import apperian, construct Ease and make the first call (Users.list), each in a fresh
+process, against a local stand-in for the region's web services. Compares authenticating in the constructor,
+lazy=True, and a token cache that already holds a token. The stand-in answers at once, so the numbers are the
+client's own cost; against the real services every request also adds a round trip.
+
+Run from the repository root: python benchmarks/startup.py
+"""
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import subprocess
+import BaseHTTPServer
+sys.path.insert(0, '.')
+
+CHILD = '''
+import sys, time
+start = time.time()
+sys.path.insert(0, '.')
+import apperian
+from apperian.modules.tokens import TokenCache
+imported = time.time()
+ease = apperian.apperian.Ease('user', 'pw', region={region}, lazy={lazy},
+                              token_cache=TokenCache({path!r}) if {cached} else None)
+constructed = time.time()
+assert ease.user.list()['status'] == 200
+called = time.time()
+modules = len([i for i in sys.modules if sys.modules[i]])
+print('{{}} {{}} {{}} {{}}'.format(imported - start, constructed - imported, called - constructed, modules))
+'''
+
+# Case name to (lazy, cached)
+CASES = [('eager', (False, False)), ('lazy', (True, False)), ('cached', (False, True))]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, otherwise delayed acks add 40 ms to requests on a kept-alive connection
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body):
+        body = json.dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.reply({'token': 'x' * 40, 'user': {'psk': 1}})
+
+    def do_GET(self):
+        self.reply({'users': [{'psk': i, 'id': 'user{}'.format(i)} for i in range(100)]})
+
+
+def run(region, lazy, cached, path):
+    code = CHILD.format(region=region, lazy=lazy, cached=cached, path=path)
+    return [float(i) for i in subprocess.check_output([sys.executable, '-c', code]).split()]
+
+
+def main(repeat=7):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}'.format(server.server_port)
+    region = {'Python Web Services': url, 'PHP Web Services': url + '/ease.interface.php', 'File Uploader': url}
+    tmp = tempfile.mkdtemp()
+    path = tmp + '/tokens.json'
+    try:
+        # Fill the token cache once for the cached case
+        run(region, False, True, path)
+        print('{:<8} {:>10} {:>12} {:>12} {:>10} {:>8}'.format('case', 'import ms', 'construct ms', 'first call ms',
+                                                              'total ms', 'modules'))
+        for name, (lazy, cached) in CASES:
+            times = sorted((run(region, lazy, cached, path) for i in range(repeat)), key=lambda i: sum(i[:3]))
+            median = times[len(times) // 2]
+            print('{:<8} {:>10.1f} {:>12.1f} {:>12.1f} {:>10.1f} {:>8}'.format(
+                name, median[0] * 1000, median[1] * 1000, median[2] * 1000, sum(median[:3]) * 1000, int(median[3])))
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
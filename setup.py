@@ -79,6 +79,7 @@ setup(
     extras_require={
         'dev': ['check-manifest'],
         'test': ['coverage'],
+        'fast': ['ujson'],
     },
 
     # If there are modules files included in your packages that need to be
@@ -0,0 +1,148 @@
+# coding=utf-8
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apperian.apperian import Ease
+from apperian.modules import regions
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, otherwise delayed acks add 40 ms to requests on a kept-alive connection
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        with self.server.lock:
+            self.server.probes += 1
+        time.sleep(self.server.delay)
+        self.reply(404)
+
+    def do_POST(self):
+        credentials = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.logins.append(credentials['user_id'])
+        if self.server.accept:
+            self.reply(200, json.dumps({'token': 'token-{}'.format(self.server.server_port), 'user': {'psk': 1}}))
+        else:
+            self.reply(401, json.dumps({'error': {'message': 'Invalid credentials'}}))
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay=0, accept=True):
+        """
+        Stand-in for the Python Web Services of a region
+
+        :param delay: Seconds to wait before answering each probe
+        :param accept: False to reject the credentials
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.delay = delay
+        self.accept = accept
+        self.probes = 0
+        self.logins = []
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def region(self):
+        url = 'http://127.0.0.1:{}'.format(self.server_port)
+        return {'Python Web Services': url, 'PHP Web Services': url + '/ease.interface.php', 'File Uploader': url}
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def closed_region():
+    """
+    :return: Region dict pointing at a port nothing listens on
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    url = 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+    sock.close()
+    return {'Python Web Services': url, 'PHP Web Services': url + '/ease.interface.php', 'File Uploader': url}
+
+
+class RegionsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'regions.json')
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tmp)
+
+    def server(self, delay=0, accept=True):
+        server = Server(delay, accept)
+        self.servers.append(server)
+        return server
+
+    def test_rank(self):
+        slow, fast, shared = self.server(0.1), self.server(), self.server(0.05)
+        candidates = {'slow': slow.region(), 'fast': fast.region(), 'default': shared.region(), 'na': shared.region(),
+                      'down': closed_region()}
+        self.assertEqual([name for name, latency in regions.rank(candidates, attempts=2, timeout=2)],
+                         ['fast', 'na', 'slow'])
+        # default and na share a host, so it is only probed once
+        self.assertEqual([slow.probes, fast.probes, shared.probes], [2, 2, 2])
+
+    def test_rank_keeps_default_without_a_named_region(self):
+        shared = self.server()
+        self.assertEqual([name for name, latency in regions.rank({'default': shared.region()}, attempts=1)],
+                         ['default'])
+        self.assertEqual(regions.rank({'down': closed_region()}, attempts=1, timeout=2), [])
+
+    def test_select_region(self):
+        fast, slow = self.server(accept=False), self.server(0.05)
+        candidates = {'fast': fast.region(), 'slow': slow.region(), 'down': closed_region()}
+        ease = Ease('user', 'pw', region=fast.region(), lazy=True)
+
+        token = ease.select_region(candidates, self.path)
+        self.assertEqual(token, 'token-{}'.format(slow.server_port))
+        self.assertEqual(ease.region, slow.region())
+        self.assertEqual([fast.logins, slow.logins], [['user'], ['user']])
+        self.assertEqual(regions.cached_region('user', self.path), 'slow')
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)['user']['region'], 'slow')
+
+        # The saved region is used straight away, without probing. Being lazy, it does not authenticate either
+        probes = fast.probes + slow.probes
+        ease = Ease('user', 'pw', region=fast.region(), lazy=True)
+        self.assertIs(ease.select_region(candidates, self.path), True)
+        self.assertEqual(ease.region, slow.region())
+        self.assertEqual(fast.probes + slow.probes, probes)
+
+    def test_select_region_fails(self):
+        rejected = self.server(accept=False)
+        ease = Ease('user', 'pw', region=rejected.region(), lazy=True)
+        self.assertFalse(ease.select_region({'rejected': rejected.region(), 'down': closed_region()}, self.path))
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
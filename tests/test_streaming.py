@@ -0,0 +1,95 @@
+# coding=utf-8
+import os
+import sys
+import json
+import random
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'apperian', 'modules'))
+
+from streaming import JSONStream
+from helpers import ResponseError
+
+
+def split(text, sizes):
+    """
+    :return: List of byte chunks of text, cut after each of sizes bytes in turn
+    """
+    body = text.encode('utf-8') if isinstance(text, unicode) else text
+    chunks, start = [], 0
+    for size in sizes:
+        chunks.append(body[start:start + size])
+        start += size
+    return chunks + [body[start:]]
+
+
+def read(chunks, *path):
+    stream = JSONStream(chunks)
+    JSONStream.find(stream, *path)
+    if JSONStream.peek(stream) == u'[':
+        return list(JSONStream.items(stream))
+    return JSONStream.value(stream)
+
+
+def random_value(rng, depth=0):
+    kind = rng.randint(0, 7 if depth < 3 else 4)
+    if kind == 0:
+        return rng.randint(-10 ** 6, 10 ** 6)
+    if kind == 1:
+        return rng.uniform(-1e6, 1e6) * 10 ** rng.randint(-8, 8)
+    if kind == 2:
+        return rng.choice([True, False, None])
+    if kind in (3, 4):
+        return u''.join(rng.choice(u'ab "\\/\n\té€😀{}[],:') for i in range(rng.randint(0, 12)))
+    if kind == 5:
+        return [random_value(rng, depth + 1) for i in range(rng.randint(0, 4))]
+    return dict(('k{}'.format(i), random_value(rng, depth + 1)) for i in range(rng.randint(0, 4)))
+
+
+class JSONStreamTest(unittest.TestCase):
+    def test_numbers_split_inside(self):
+        for chunks in [['{"a": [86145.', '51]}'], ['{"a": [1e', '5]}'], ['{"a": [1e+', '5]}'], ['{"a": [-', '3]}'],
+                       ['{"a": [12', '34, 5]}'], ['{"a": [1.5e-', '7, 2]}'], ['{"a": 4', '2}']]:
+            self.assertEqual(read(chunks, 'a'), json.loads(''.join(chunks))['a'])
+
+    def test_strings_split_inside(self):
+        text = u'{"a": ["hello world", "say \\"hi\\"", "back\\\\slash", "\\u00e9\\ud83d\\ude00", "é€"]}'
+        for size in range(1, len(text.encode('utf-8'))):
+            self.assertEqual(read(split(text, [size]), 'a'), json.loads(text)['a'])
+
+    def test_escapes_split_inside(self):
+        for chunks in [['{"a": ["x\\', '"y"]}'], ['{"a": ["\\u00', 'e9"]}'], ['{"skip": "\\', '"]", "a": [1]}'],
+                       ['{"skip": ["\\\\', '", "]"], "a": [1]}']]:
+            self.assertEqual(read(chunks, 'a'), json.loads(''.join(chunks))['a'])
+
+    def test_multibyte_split_inside(self):
+        text = u'{"a": ["€😀"]}'.encode('utf-8')
+        for size in range(1, len(text)):
+            self.assertEqual(read(split(text, [size]), 'a'), [u'€😀'])
+
+    def test_skips_other_keys(self):
+        text = '{"other": [{"x": "]}"}, 1.5], "nested": {"a": [2]}, "a": [{"b": [1, {"c": null}]}, true]}'
+        for size in range(1, len(text)):
+            self.assertEqual(read(split(text, [size] * len(text)), 'a'), [{'b': [1, {'c': None}]}, True])
+            self.assertEqual(read(split(text, [size] * len(text)), 'nested', 'a'), [2])
+
+    def test_errors(self):
+        with self.assertRaises(ResponseError) as e:
+            read(['{"error": {"message": "bad token"}}'], 'a')
+        self.assertEqual(e.exception.status, 401)
+        with self.assertRaises(ResponseError) as e:
+            read(['{"b": [1]}'], 'a')
+        self.assertEqual(e.exception.status, 500)
+        with self.assertRaises(ValueError):
+            read(['{"a": [1, 2'], 'a')
+
+    def test_random_documents_at_random_chunk_sizes(self):
+        rng = random.Random(0)
+        for i in range(1000):
+            items = [random_value(rng) for n in range(rng.randint(0, 6))]
+            text = json.dumps({'before': random_value(rng), 'a': items, 'after': random_value(rng)})
+            sizes = [rng.randint(1, 16) for n in range(len(text))]
+            self.assertEqual(read(split(text, sizes), 'a'), json.loads(text)['a'], text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,297 @@
+# coding=utf-8
+import os
+import re
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+import requests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'apperian', 'modules'))
+
+import transfer
+
+DATA = ''.join(chr(i % 251) for i in range(100000))
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, otherwise delayed acks add 40 ms to requests on a kept-alive connection
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        requested = self.headers.get('Range')
+        with server.lock:
+            server.ranges.append(requested)
+        match = re.match(r'bytes=(\d+)-(\d*)$', requested or '')
+        probing = requested == 'bytes=0-0'
+        if match and server.honour_ranges and (probing or not server.probe_only):
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(DATA) - 1
+            body = DATA[start:end + 1]
+            if server.truncate and not probing:
+                body = body[:-server.truncate]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(DATA)))
+        else:
+            body = DATA
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with server.lock:
+            server.posts.append((self.headers, body))
+            reply = server.replies.pop(0) if server.replies else 200
+        if reply is None:
+            # Hang up without answering
+            self.close_connection = 1
+            return
+        self.send_response(reply)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, honour_ranges=True, probe_only=False, truncate=0, replies=None):
+        """
+        :param honour_ranges: False to always answer with the whole file
+        :param probe_only: True to only honour the bytes=0-0 probe and answer every other range with the whole file
+        :param truncate: Number of bytes to leave off the end of every range but the probe
+        :param replies: Optional. Status codes to answer posts with in turn, None to drop the connection instead.
+            Posts after those get a 200
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.honour_ranges = honour_ranges
+        self.probe_only = probe_only
+        self.truncate = truncate
+        self.replies = list(replies or [])
+        self.ranges = []
+        self.posts = []
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # The client hangs up without reading the rest of the file after the probe
+        pass
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:{}/app.ipa'.format(self.server_port)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class DownloadFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.tmp, 'app.ipa')
+        self.session = requests.Session()
+        self.min_segment_size = transfer.MIN_SEGMENT_SIZE
+        transfer.MIN_SEGMENT_SIZE = 1024
+
+    def tearDown(self):
+        transfer.MIN_SEGMENT_SIZE = self.min_segment_size
+        self.session.close()
+        shutil.rmtree(self.tmp)
+
+    def download(self, server, **kwargs):
+        url = server.start()
+        try:
+            return transfer.download_file(self.session, url, self.file_name, 4096, **kwargs)
+        finally:
+            server.stop()
+
+    def downloaded(self):
+        with open(self.file_name, 'rb') as f:
+            return f.read()
+
+    def leftovers(self):
+        return [i for i in os.listdir(self.tmp) if i != 'app.ipa']
+
+    def test_segments(self):
+        server = Server()
+        progress = []
+        resp = self.download(server, segments=4, progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(resp, {'status': 200, 'result': self.file_name})
+        self.assertEqual(self.downloaded(), DATA)
+        self.assertEqual(sorted(server.ranges), ['bytes=0-0', 'bytes=0-24999', 'bytes=25000-49999',
+                                                 'bytes=50000-74999', 'bytes=75000-99999'])
+        self.assertEqual(progress[-1], (len(DATA), len(DATA)))
+        self.assertEqual(self.leftovers(), [])
+
+    def test_resumes_part(self):
+        with open(self.file_name + '.part', 'wb') as f:
+            f.write(DATA[:30000])
+        server = Server()
+        resp = self.download(server, segments=4)
+        self.assertEqual(resp['status'], 200)
+        self.assertEqual(self.downloaded(), DATA)
+        self.assertEqual(server.ranges, ['bytes=0-0', 'bytes=30000-99999'])
+        self.assertEqual(self.leftovers(), [])
+
+    def test_no_range_support(self):
+        with open(self.file_name + '.part', 'wb') as f:
+            f.write('stale')
+        server = Server(honour_ranges=False)
+        resp = self.download(server, segments=4)
+        self.assertEqual(resp['status'], 200)
+        self.assertEqual(self.downloaded(), DATA)
+        self.assertEqual(server.ranges, ['bytes=0-0', None])
+        self.assertEqual(self.leftovers(), [])
+
+    def test_segment_answered_with_whole_file(self):
+        server = Server(probe_only=True)
+        progress = []
+        resp = self.download(server, segments=4, progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(resp['status'], 200)
+        self.assertEqual(self.downloaded(), DATA)
+        self.assertEqual(server.ranges[-1], None)
+        self.assertEqual(progress[-1], (len(DATA), len(DATA)))
+        self.assertEqual(self.leftovers(), [])
+
+    def test_size_mismatch(self):
+        server = Server(truncate=10)
+        resp = self.download(server, segments=1)
+        self.assertEqual(resp['status'], 500)
+        self.assertIn('Size mismatch', resp['result'])
+        self.assertFalse(os.path.exists(self.file_name))
+        # The bytes that did arrive are kept to resume from
+        self.assertEqual(os.path.getsize(self.file_name + '.part'), len(DATA) - 10)
+
+    def test_checksum(self):
+        digest = hashlib.sha1(DATA).hexdigest()
+        resp = self.download(Server(), segments=4, checksum=('sha1', digest.upper()))
+        self.assertEqual(resp['status'], 200)
+        self.assertEqual(self.downloaded(), DATA)
+
+        os.remove(self.file_name)
+        resp = self.download(Server(), segments=4, checksum=('sha1', '0' * 40))
+        self.assertEqual(resp['status'], 500)
+        self.assertIn('sha1 mismatch', resp['result'])
+        self.assertFalse(os.path.exists(self.file_name))
+        self.assertEqual(self.leftovers(), [])
+
+
+
+def multipart(body):
+    """
+    :return: Tuple of (field name, file name, file contents) of a multipart body with a single file
+    """
+    boundary = body[2:body.index('\r\n')]
+    head, rest = body.split('\r\n\r\n', 1)
+    match = re.search(r'name="(.*?)"; filename="(.*?)"', head)
+    tail = '\r\n--{}--\r\n'.format(boundary)
+    assert rest.endswith(tail), 'Body does not end with the closing boundary'
+    return match.group(1), match.group(2), rest[:-len(tail)]
+
+
+class MultipartFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'app.ipa')
+        with open(self.path, 'wb') as f:
+            f.write(DATA)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read_all(self, body, size):
+        data = ''
+        for block in iter(lambda: body.read(size), b''):
+            data += block
+        body.close()
+        return data
+
+    def test_body(self):
+        for size in [1, 7, 4096, -1]:
+            body = transfer.MultipartFile(self.path, 'LUuploadFile')
+            data = self.read_all(body, size)
+            self.assertEqual(len(data), len(body))
+            self.assertEqual(multipart(data), ('LUuploadFile', 'app.ipa', DATA))
+            self.assertIn(body.boundary, body.content_type)
+
+    def test_range(self):
+        tracker = transfer.Progress(None, len(DATA))
+        body = transfer.MultipartFile(self.path, 'LUuploadFile', tracker, 1000, 2500)
+        data = self.read_all(body, 300)
+        self.assertEqual(len(data), len(body))
+        self.assertEqual(multipart(data)[2], DATA[1000:3500])
+        self.assertEqual(tracker.done, 2500)
+
+        body = transfer.MultipartFile(self.path, 'LUuploadFile', offset=len(DATA) - 10, length=2500)
+        self.assertEqual(multipart(self.read_all(body, 300))[2], DATA[-10:])
+
+
+class UploadFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'app.ipa')
+        with open(self.path, 'wb') as f:
+            f.write(DATA)
+        self.session = requests.Session()
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmp)
+
+    def upload(self, server, **kwargs):
+        url = server.start()
+        try:
+            return transfer.upload_file(self.session, url, self.path, backoff=0, **kwargs)
+        finally:
+            server.stop()
+
+    def test_upload(self):
+        server = Server()
+        progress = []
+        r = self.upload(server, progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(server.posts), 1)
+        headers, body = server.posts[0]
+        self.assertEqual(int(headers['Content-Length']), len(body))
+        self.assertNotIn('Transfer-Encoding', headers)
+        self.assertTrue(headers['Content-Type'].startswith('multipart/form-data; boundary='))
+        self.assertEqual(multipart(body), ('LUuploadFile', 'app.ipa', DATA))
+        self.assertEqual(progress[0], (0, len(DATA)))
+        self.assertEqual(progress[-1], (len(DATA), len(DATA)))
+        self.assertEqual([done for done, total in progress], sorted(done for done, total in progress))
+
+    def test_retries(self):
+        server = Server(replies=[503, None, 502])
+        progress = []
+        r = self.upload(server, progress=lambda done, total: progress.append(done))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(server.posts), 4)
+        for headers, body in server.posts:
+            self.assertEqual(multipart(body)[2], DATA)
+        # Every attempt reports the file from the start again
+        self.assertEqual(progress.count(0), 4)
+        self.assertEqual(progress[-1], len(DATA))
+
+    def test_gives_up(self):
+        r = self.upload(Server(replies=[500, 500, 500]), retries=2)
+        self.assertEqual(r.status_code, 500)
+        with self.assertRaises(requests.ConnectionError):
+            self.upload(Server(replies=[None, None]), retries=1)
+        r = self.upload(Server(replies=[400]))
+        self.assertEqual(r.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()